@@ -37,12 +37,21 @@ __version__ = "2.0.5"
 from docopt import docopt
 import json
 import os
+import sys
 import glob
 import requests
 import logging
 import httplib
 from datadog import initialize, api
 
+# Shares the API rate limits with the other scripts of the host, with api_throttle.py from the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    import api_throttle
+    api_throttle.install()
+except ImportError:
+    sys.stderr.write("api_throttle.py not found, the API rate limits are not shared with the other scripts\n")
+
 # Debug logging
 httplib.HTTPConnection.debuglevel = 1
 logging.basicConfig()
@@ -1,5 +1,8 @@
 #-*- coding: utf-8 -*-
 
+# Spends a call of each endpoint to read its rate limit. To watch the rate limits without spending them, scripts can
+# use rate_limit_telemetry.py instead, which sends the same metrics from the responses of the calls they already make.
+
 # stdlib
 import time
 
@@ -0,0 +1,197 @@
+"""
+Datadog API rate limits shared between processes.
+
+Scripts running at the same time on a host each see only their own requests, so together they go over the rate limits
+of the org and all get 429s. This module keeps one token bucket per API key and endpoint in a file that all of them
+share: before a request is sent a token is taken from its bucket, waiting for one when the bucket is empty, and the
+buckets are seeded and kept right by the X-RateLimit-* headers of the responses. A bucket lets a tenth of the limit of
+its endpoint go at once, and then refills at the rate the limit allows, so that concurrent scripts take turns instead
+of the first one spending the whole limit.
+
+Scripts use it when it is there, and run as before when it isn't:
+
+    try:
+        import api_throttle
+        api_throttle.install()
+    except ImportError:
+        pass
+
+install() throttles every requests session of the process, including the one the datadog library makes.
+instrument(session) throttles a single session. Both wrap requests.Session.send, so they keep working whatever
+transport adapters a session mounts. Only requests to Datadog hosts are throttled, and an endpoint isn't throttled
+before a response has given its limit. The endpoints are named as in rate_limit_telemetry.py, which must be next to
+this file. Scripts in subdirectories add the root of the repository to sys.path to import it.
+
+The buckets are kept in API_THROTTLE_DIR, by default datadog-api-throttle in the temporary directory, and the share of
+the limit let go at once can be set with API_THROTTLE_BURST. Buckets are per API key: scripts using different API keys
+of the same org don't share them. Once a response has given the name of the limit of its endpoint (X-RateLimit-Name),
+the endpoint takes its tokens from the bucket of that limit, shared by all the endpoints counting against it.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import requests
+
+from rate_limit_telemetry import endpoint_of
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (Windows), the buckets are only shared between the threads of a process
+    fcntl = None
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+THROTTLE_DIR = os.environ.get('API_THROTTLE_DIR', os.path.join(tempfile.gettempdir(), 'datadog-api-throttle'))
+BURST = float(os.environ.get('API_THROTTLE_BURST', 0.1))
+# Longest sleep between two looks at a bucket, which other processes may have seeded with newer limits meanwhile
+MAX_SLEEP = 10
+
+DATADOG_HOST_RE = re.compile(r'(^|\.)(datadoghq\.com|datadoghq\.eu|ddog-gov\.com)$')
+BUCKET_NAME_RE = re.compile(r'[^\w.-]')
+
+_thread_lock = threading.Lock()
+
+class Bucket(object):
+    """ The token bucket of an API key and endpoint, in a file locked by whoever reads or changes it. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def update(self, change):
+        # Calls change(state, now) with the bucket locked and saves the state it leaves, returns what change returns
+        if not os.path.isdir(THROTTLE_DIR):
+            try:
+                os.makedirs(THROTTLE_DIR)
+            except OSError:
+                pass
+        with _thread_lock if fcntl is None else _NoLock():
+            with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                result = change(state, time.time())
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                return result
+
+    def acquire(self):
+        # Takes a token, waiting for one as long as it takes
+        while True:
+            wait = self.update(take)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, MAX_SLEEP))
+
+    def seed(self, headers):
+        self.update(lambda state, now: seed(state, headers, now))
+
+class _NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+def take(state, now):
+    # Takes a token and returns 0, or returns the seconds until there is one
+    if 'limit' not in state:
+        return 0
+    if now >= state['window_end']:
+        # The window of the limit ended, the whole limit is left until a response says otherwise
+        state['remaining'] = state['limit']
+        state['window_end'] = now + state['period']
+    rate = float(state['limit']) / state['period']
+    state['tokens'] = min(max(1.0, state['limit'] * BURST), state['tokens'] + (now - state['updated']) * rate)
+    state['updated'] = now
+    if state['remaining'] <= 0:
+        return state['window_end'] - now
+    if state['tokens'] < 1:
+        return (1 - state['tokens']) / rate
+    state['tokens'] -= 1
+    state['remaining'] -= 1
+    return 0
+
+def seed(state, headers, now):
+    try:
+        limit = int(headers['X-RateLimit-Limit'])
+        period = int(headers['X-RateLimit-Period'])
+        remaining = int(headers['X-RateLimit-Remaining'])
+        window_end = now + int(headers['X-RateLimit-Reset'])
+    except (KeyError, ValueError):
+        return
+    if limit <= 0 or period <= 0:
+        return
+    if 'limit' not in state:
+        state.update(tokens=min(max(1.0, limit * BURST), remaining), updated=now)
+    elif window_end <= state['window_end'] + 1:
+        # Responses of the same window come back in any order, the lowest count left is the most recent one
+        remaining = min(remaining, state['remaining'])
+    state.update(limit=limit, period=period, remaining=remaining, window_end=window_end)
+
+def limit_of(request):
+    # Returns the hash of the API key and the endpoint of a request to the Datadog API, or None
+    url = urlparse(request.url)
+    if not DATADOG_HOST_RE.search(url.hostname or ''):
+        return None
+    api_key = request.headers.get('DD-API-KEY') or parse_qs(url.query).get('api_key', [None])[0]
+    if not api_key:
+        return None
+    return hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:16], endpoint_of(request.url)
+
+def bucket_of(limit):
+    # Endpoints that a response has said count against a named rate limit share its bucket
+    name = _limit_names.get(limit)
+    bucket = 'limit-' + name if name else 'endpoint-' + limit[1]
+    return Bucket(os.path.join(THROTTLE_DIR, '{0}-{1}.json'.format(limit[0], BUCKET_NAME_RE.sub('_', bucket))))
+
+def throttled_send(self, request, **kwargs):
+    # Stands in for requests.Session.send, which every request of every session goes through whatever transport
+    # adapters are mounted on the session; the datadog library mounts its own over any mounted before
+    limit = limit_of(request) if _installed or getattr(self, 'api_throttled', False) else None
+    if limit is not None:
+        bucket_of(limit).acquire()
+    response = _original_send(self, request, **kwargs)
+    if limit is not None:
+        name = response.headers.get('X-RateLimit-Name')
+        if name:
+            _limit_names[limit] = name
+        bucket_of(limit).seed(response.headers)
+    return response
+
+_lock = threading.Lock()
+_installed = False
+_original_send = None
+_limit_names = {} # (API key hash, endpoint) -> X-RateLimit-Name of the limit of the endpoint
+
+def _patch_send():
+    global _original_send
+    with _lock:
+        if _original_send is None:
+            _original_send = requests.Session.send
+            requests.Session.send = throttled_send
+
+def instrument(session):
+    """ Throttles the requests of session to the Datadog API. """
+    _patch_send()
+    session.api_throttled = True
+    return session
+
+def install():
+    """ Throttles the requests to the Datadog API of every requests session of the process. """
+    global _installed
+    _patch_send()
+    _installed = True
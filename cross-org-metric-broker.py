@@ -1,45 +1,292 @@
-from datadog import initialize, api 
+import os
 import sys
 import time
 import json
+import random
+import threading
+import zlib
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue, Empty
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from Queue import Queue, Empty
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import requests
 import yaml
 
+try:
+    import rate_limit_telemetry
+except ImportError:
+    rate_limit_telemetry = None
+
+try:
+    import api_throttle
+except ImportError:
+    api_throttle = None
+
+DEFAULT_API_HOST = 'https://api.datadoghq.com'
+MAX_CONCURRENT_ORGS = 8
+MAX_ATTEMPTS = 3
+
+# Seconds of data queried the first time a query is asked
+DEFAULT_WINDOW = 60
+# Seconds points take to be queryable after their timestamp; the most recent ones aren't forwarded until then
+INGESTION_DELAY = 60
+# After a gap, at most MAX_BACKFILL seconds are caught up, in queries of at most BACKFILL_CHUNK seconds
+BACKFILL_CHUNK = 3600
+MAX_BACKFILL = 86400
+# Seconds after which the tags applied to a host are checked again, and after which a host no longer seen is forgotten
+HOST_TAG_VERIFY_INTERVAL = 86400
+HOST_TAG_RETENTION = 7 * 86400
+# Metrics are queried together, in requests of at most MAX_QUERIES_PER_REQUEST queries and MAX_QUERY_LENGTH characters
+MAX_QUERIES_PER_REQUEST = 10
+MAX_QUERY_LENGTH = 2000
+# In daemon mode each org is forwarded every DAEMON_INTERVAL seconds, give or take a tenth of it, with at most
+# QUEUE_SIZE orgs fetched and waiting to be posted
+DAEMON_INTERVAL = 60
+QUEUE_SIZE = 32
+SCHEDULER_TICK = 1
+
+def config_path():
+    return str(sys.path[0] + '/cross-org-metric-broker.yaml')
+
 def load_config():
-    f = open(str(sys.path[0] + '/cross-org-metric-broker.yaml'))
+    f = open(config_path())
     config = yaml.safe_load(f)
     f.close()
 
     return config
 
-def get_metrics(auth_key, metrics):
-    options = {
-        'api_key': auth_key['api_key'],
-        'app_key': auth_key['app_key']
-    }
-    initialize(**options)
+def state_path(config):
+    return config['init_config'].get('state_file', str(sys.path[0] + '/cross-org-metric-broker.state.json'))
+
+def load_state(path):
+    # queried_until: account name -> query -> end of the last window forwarded, where the next one starts
+    # watermarks: account name -> query -> timestamp of the last point forwarded, older points aren't forwarded again
+    # host_tags: account name -> hostname -> tags applied to the host and when they were last checked
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        state = {}
+    if 'watermarks' not in state:
+        # state files written before host tags were cached only held watermarks
+        state = {'watermarks': state}
+    state.setdefault('queried_until', {})
+    state.setdefault('host_tags', {})
+    return state
+
+def save_state(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    if hasattr(os, 'replace'):
+        os.replace(path + '.tmp', path)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+def query_windows(start, end, config):
+    if start is None:
+        return [(end - DEFAULT_WINDOW, end)]
+    chunk = config.get('backfill_chunk', BACKFILL_CHUNK)
+    start = max(int(start), end - config.get('max_backfill', MAX_BACKFILL))
+    windows = []
+    while start < end:
+        windows.append((start, min(start + chunk, end)))
+        start += chunk
+    return windows
+
+class OrgClient(object):
+    """
+    Talks to the API of one org with its own keys, HTTP session and rate limit budget, so that clients of different
+    orgs can be used at the same time (the datadog module's api keeps a single set of keys for the whole process).
+    """
+
+    def __init__(self, api_key, app_key, api_host=DEFAULT_API_HOST, timeout=60):
+        self.api_host = api_host.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'DD-API-KEY': api_key, 'DD-APPLICATION-KEY': app_key})
+        # Rate limit family -> (requests remaining, time at which the budget resets), from the X-RateLimit headers
+        self.rate_limits = {}
+
+    def request(self, method, path, family, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            self.wait_for_budget(family)
+            response = self.session.request(method, self.api_host + path, timeout=self.timeout, **kwargs)
+            self.update_budget(family, response.headers)
+            if response.status_code == 429 and attempt < MAX_ATTEMPTS - 1:
+                # Without rate limit headers to wait on, back off
+                if self.rate_limits.get(family, (1, 0))[0] > 0:
+                    time.sleep(2 ** attempt)
+                continue
+            response.raise_for_status()
+            return response.json() if response.content else {}
+
+    def wait_for_budget(self, family):
+        remaining, reset_at = self.rate_limits.get(family, (1, 0))
+        if remaining <= 0 and reset_at > time.time():
+            time.sleep(reset_at - time.time())
+
+    def update_budget(self, family, headers):
+        try:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset_at = time.time() + int(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+        self.rate_limits[family] = (remaining, reset_at)
 
-    end = int(time.time())
-    start = end - 60
+    def query_metrics(self, start, end, query):
+        return self.request('GET', '/api/v1/query', 'query', params={'from': start, 'to': end, 'query': query})
 
-    results = []
+    def send_series(self, series, compress=True):
+        body = json.dumps({'series': series}).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if compress:
+            body = zlib.compress(body)
+            headers['Content-Encoding'] = 'deflate'
+        return self.request('POST', '/api/v1/series', 'series', data=body, headers=headers)
+
+    def get_host_tags(self, hostname):
+        return self.request('GET', '/api/v1/tags/hosts/' + requests.utils.quote(hostname, safe=''), 'tags')['tags']
+
+    def create_host_tags(self, hostname, tags):
+        return self.request('POST', '/api/v1/tags/hosts/' + requests.utils.quote(hostname, safe=''), 'tags',
+                            json={'tags': tags})
+
+def org_client(account_name, keys, config):
+    # With rate_limit_telemetry, the rate limits seen in the responses of each org are sent as metrics tagged with it
+    client = OrgClient(*keys)
+    if rate_limit_telemetry is not None and config.get('rate_limit_telemetry', False):
+        rate_limit_telemetry.instrument(client.session, ['org:' + account_name])
+    # With shared_rate_limits, the requests of each org wait on rate limits shared with the other scripts of the host
+    if api_throttle is not None and config.get('shared_rate_limits', False):
+        api_throttle.instrument(client.session)
+    return client
+
+def start_rate_limit_telemetry(config):
+    if rate_limit_telemetry is not None and config.get('rate_limit_telemetry', False):
+        rate_limit_telemetry.start_flushing(config['primary_api_key'], ['script:cross-org-metric-broker'],
+                                            config.get('api_host', DEFAULT_API_HOST))
+
+def batch_queries(queries, max_queries, max_length):
+    # Splits queries into comma separated groups of at most max_queries queries and max_length characters
+    batch = []
+    batch_length = 0
+    for query in queries:
+        if batch and (len(batch) >= max_queries or batch_length + len(query) + 1 > max_length):
+            yield batch
+            batch = []
+            batch_length = 0
+        batch.append(query)
+        batch_length += len(query) + 1
+    if batch:
+        yield batch
+
+def query_alone(client, start, end, query):
+    try:
+        return client.query_metrics(start, end, query)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 400:
+            raise
+        # It isn't moved past this window, so it is asked again, from the same point, once the query is fixed
+        print("invalid query " + query + ": " + str(e))
+        return {'series': [], 'invalid': True}
+
+def query_batch(client, start, end, queries):
+    # Sends queries as one request and returns the response of each query: the API answers a comma separated list of
+    # queries with the series of all of them, each with the index of the query it belongs to
+    if len(queries) == 1:
+        return [query_alone(client, start, end, queries[0])]
+    try:
+        response = client.query_metrics(start, end, ','.join(queries))
+    except requests.HTTPError as e:
+        # A single invalid query fails the whole request, ask the others on their own so that only it fails
+        if e.response is None or e.response.status_code != 400:
+            raise
+        return [query_alone(client, start, end, query) for query in queries]
+    responses = [{'series': []} for query in queries]
+    for series in response.get('series', []):
+        responses[series.get('query_index', 0)]['series'].append(series)
+    return responses
+
+def get_metrics(client, metrics, watermarks, queried_until, end, config):
+    # Queries each metric from the end of its last window up to end, and returns the query and the responses of each
+    # metric. The metrics with the same windows, which is all of them once they are caught up, are asked together.
+    max_queries = config.get('max_queries_per_request', MAX_QUERIES_PER_REQUEST)
+    max_length = config.get('max_query_length', MAX_QUERY_LENGTH)
+    queries_by_windows = {}
     for metric in metrics:
-        result = api.Metric.query(start=start, end=end, query=metric['metric'])
-        results.append(result)
+        # state files written before queried_until was kept only have the watermarks to start from
+        start = queried_until.get(metric['metric'], watermarks.get(metric['metric']))
+        windows = tuple(query_windows(start, end, config))
+        queries_by_windows.setdefault(windows, []).append(metric['metric'])
 
-    return results
+    responses = dict((metric['metric'], []) for metric in metrics)
+    for windows, queries in queries_by_windows.items():
+        for batch in batch_queries(queries, max_queries, max_length):
+            for start, window_end in windows:
+                for query, response in zip(batch, query_batch(client, start, window_end, batch)):
+                    responses[query].append(response)
 
-def post_metrics(auth_key, customer_name, hostname, pointlist, metric_name):
-    options = {
-        'api_key': auth_key['primary_api_key'],
-        'app_key': auth_key['primary_app_key']
-    }
-    initialize(**options)
+    return [(metric['metric'], responses[metric['metric']]) for metric in metrics]
 
-    CurrentPosixTime = time.time()
-    CurrentPosixTime10 = time.time() + 10
+def merge_series(responses, watermark):
+    # Merges the series of consecutive windows, which share their boundaries, and drops the points already forwarded
+    merged = {}
+    for response in responses:
+        for series in response['series']:
+            points = merged.setdefault((str(series['expression']), series['scope']), {})
+            for timestamp, value in convert_pointlist_to_seconds(list(series['pointlist'])):
+                if value is not None and (watermark is None or timestamp > watermark):
+                    points[timestamp] = value
+    return [(expression, scope, [[timestamp, points[timestamp]] for timestamp in sorted(points)])
+            for (expression, scope), points in sorted(merged.items()) if points]
 
-    api.Metric.send(metric=metric_name, points=pointlist, host=hostname, tags=["customer:"+customer_name])
+# Limits of a single series payload: the API rejects request bodies over 3.2 MB, and compressed ones over 62 MB once
+# decompressed. 5 MB of JSON compresses well under 3.2 MB, uncompressed payloads are held to the 3.2 MB themselves.
+MAX_SERIES_PER_PAYLOAD = 1000
+MAX_PAYLOAD_BYTES = 5 * 1024 * 1024
+MAX_UNCOMPRESSED_PAYLOAD_BYTES = 3200000 - len(json.dumps({'series': []}))
 
+def batch_series(series, max_series, max_bytes):
+    # Splits series into payloads of at most max_series series and max_bytes of (uncompressed) JSON
+    batch = []
+    batch_bytes = 0
+    for s in series:
+        size = len(json.dumps(s)) + len(', ')
+        if batch and (len(batch) >= max_series or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(s)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def post_metrics(client, config, series):
+    max_series = config.get('max_series_per_payload', MAX_SERIES_PER_PAYLOAD)
+    max_bytes = config.get('max_payload_bytes', MAX_PAYLOAD_BYTES)
+    compress = config.get('compress_payload', True)
+    if not compress:
+        max_bytes = min(max_bytes, MAX_UNCOMPRESSED_PAYLOAD_BYTES)
+
+    payloads = 0
+    failed = 0
+    for batch in batch_series(series, max_series, max_bytes):
+        try:
+            client.send_series(batch, compress)
+        except requests.RequestException as e:
+            print("failed to post " + str(len(batch)) + " series: " + str(e))
+            failed += 1
+        payloads += 1
+
+    return payloads, failed
 
 def convert_pointlist_to_seconds(pointlist):
     plc = len(pointlist)
@@ -52,16 +299,74 @@ def convert_pointlist_to_seconds(pointlist):
 
     return pointlist
 
-def add_host_tag(auth_key, hostname, customer_name):
-    options = {
-        'api_key': auth_key['primary_api_key'],
-        'app_key': auth_key['primary_app_key']
-    }
+def add_host_tag(client, hostname, customer_name):
+    try:
+        client.create_host_tags(hostname, ["customer:" + customer_name])
+        return True
+    except requests.RequestException as e:
+        print("failed to tag host " + hostname + ": " + str(e))
+        return False
+
+def tag_host(client, host_tags, hostname, customer_name, now, verify_interval):
+    # Tags a host unless it is known to have been tagged already: the tags of a host almost never change, so they are
+    # only written for new hosts, and checked once every verify_interval in case someone removed them
+    tags = ["customer:" + customer_name]
+    cached = host_tags.setdefault(customer_name, {}).get(hostname)
+    if cached is not None and cached['tags'] == tags:
+        if now - cached['verified'] < verify_interval:
+            return
+        try:
+            current_tags = client.get_host_tags(hostname)
+        except requests.RequestException as e:
+            print("failed to get the tags of host " + hostname + ": " + str(e))
+            return
+        if all(tag in current_tags for tag in tags):
+            cached['verified'] = now
+            return
+
+    if add_host_tag(client, hostname, customer_name):
+        host_tags[customer_name][hostname] = {'tags': tags, 'verified': now}
+
+def forget_old_hosts(host_tags, now, retention):
+    for customer_name in list(host_tags):
+        for hostname in list(host_tags[customer_name]):
+            if now - host_tags[customer_name][hostname]['verified'] > retention:
+                del host_tags[customer_name][hostname]
+
+def customer_series(customer_name, metric_data, watermarks, new_watermarks):
+    # Returns the series to post from the metrics of a customer, and moves its watermarks in new_watermarks
+    series_to_post = []
+    for query, responses in metric_data:
+        for expression, hostname, pointlist in merge_series(responses, watermarks.get(query)):
+            metric_name = expression.rpartition('{')[0]
 
-    initialize(**options)
+            print("account name: " + customer_name)
+            print("metric name: " + metric_name)
+            print("metric data: " + str(pointlist))
 
-    api.Tag.create(hostname, tags=["customer:"+customer_name])
+            series_to_post.append({
+                'metric': metric_name,
+                'points': pointlist,
+                'host': hostname,
+                'tags': ["customer:" + customer_name]
+            })
+            new_watermarks[query] = max(new_watermarks.get(query, pointlist[-1][0]), pointlist[-1][0])
 
+    return series_to_post
+
+def move_queried_until(metric_data, end, queried_until):
+    # Every query answered was asked up to end, whether it had points or not, and starts from there next time
+    for query, responses in metric_data:
+        if not any(response.get('invalid') for response in responses):
+            queried_until[query] = end
+
+def fetch_customer_metrics(customer):
+    # Runs on the pool, one org per worker
+    customer_name, client, metrics, watermarks, end, config, queried_until = customer
+    try:
+        return get_metrics(client, metrics, watermarks, queried_until, end, config), None
+    except requests.RequestException as e:
+        return None, e
 
 def process_metrics():
     config = load_config()
@@ -69,23 +374,334 @@ def process_metrics():
     customer_keys = config['instances']
     metrics = config['metrics']
 
-    for customer_key in customer_keys:
-        customer_name = customer_key['account_name']
+    # Each run forwards the points between the last one forwarded for each org and query, and now minus the
+    # ingestion delay, so that points are neither sent twice nor missed whatever the time between runs
+    state = load_state(state_path(config))
+    now = int(time.time())
+    end = now - primary_key.get('ingestion_delay', INGESTION_DELAY)
+    host_tags = state['host_tags']
+    verify_interval = primary_key.get('host_tag_verify_interval', HOST_TAG_VERIFY_INTERVAL)
+
+    api_host = primary_key.get('api_host', DEFAULT_API_HOST)
+    start_rate_limit_telemetry(primary_key)
+    primary_client = org_client('primary', (primary_key['primary_api_key'], primary_key['primary_app_key'], api_host),
+                                primary_key)
+    customers = [(customer_key['account_name'],
+                  org_client(customer_key['account_name'], (customer_key['api_key'], customer_key['app_key'],
+                                                            customer_key.get('api_host', api_host)), primary_key),
+                  metrics, state['watermarks'].get(customer_key['account_name'], {}), end, primary_key,
+                  state['queried_until'].get(customer_key['account_name'], {}))
+                 for customer_key in customer_keys]
+
+    # Orgs are polled concurrently, so that a run takes about as long as the slowest org
+    pool = ThreadPool(max(1, min(primary_key.get('max_concurrent_orgs', MAX_CONCURRENT_ORGS), len(customers))))
+    try:
+        customer_data = pool.map(fetch_customer_metrics, customers)
+    finally:
+        pool.close()
+
+    # Every series of every customer is posted at once at the end of the run, in as few payloads as possible
+    series_to_post = []
+    new_watermarks = dict((customer_name, dict(watermarks))
+                          for customer_name, watermarks in state['watermarks'].items())
+    new_queried_until = dict((customer_name, dict(queried_until))
+                             for customer_name, queried_until in state['queried_until'].items())
+    for customer, (metric_data, error) in zip(customers, customer_data):
+        customer_name = customer[0]
+        if error is not None:
+            print("failed to get metrics of account " + customer_name + ": " + str(error))
+            continue
+
+        series = customer_series(customer_name, metric_data, state['watermarks'].get(customer_name, {}),
+                                 new_watermarks.setdefault(customer_name, {}))
+        move_queried_until(metric_data, end, new_queried_until.setdefault(customer_name, {}))
+        for s in series:
+            tag_host(primary_client, host_tags, s['host'], customer_name, now, verify_interval)
+        series_to_post.extend(series)
+
+    payloads, failed = post_metrics(primary_client, primary_key, series_to_post)
+    print("posted " + str(len(series_to_post)) + " series in " + str(payloads) + " payloads")
+
+    # The watermarks only move once their points are posted, a failed run is retried from the same place
+    if failed:
+        print(str(failed) + " payloads failed, the watermarks are left unchanged")
+    else:
+        state['watermarks'] = new_watermarks
+        state['queried_until'] = new_queried_until
+    forget_old_hosts(host_tags, now, primary_key.get('host_tag_retention', HOST_TAG_RETENTION))
+    save_state(state_path(config), state)
+
+class BrokerDaemon(object):
+    """
+    Forwards the metrics of every org from a single long running process, each org on its own schedule: every
+    interval seconds, give or take jitter seconds so that the orgs don't all hit the API at the same time.
+
+    Orgs are fetched on a pool and handed to a single poster thread through a bounded queue. When posting falls behind
+    the queue fills up and the fetches block on it, and an org isn't fetched again until its previous fetch has been
+    posted. The configuration file is reloaded when it changes: orgs can be added, removed or given new keys, and the
+    metrics and settings changed, without restarting. The state file, pool size, queue size and health port are only
+    read at start.
+    """
+
+    def __init__(self):
+        self.config = None
+        self.config_mtime = None
+        self.metrics = []
+        self.instances = {} # account name -> instance
+        self.clients = {} # account name -> (keys, OrgClient)
+        self.primary = None # (keys, OrgClient)
+        self.schedule = {} # account name -> time of its next fetch
+        self.status = {} # account name -> lag, time of the last forward, last error
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.state = None
+        self.queue = None
+        self.pool = None
+        self.poster = None
+
+    def interval(self, instance):
+        return instance.get('interval', self.config['init_config'].get('interval', DAEMON_INTERVAL))
+
+    def jitter(self, instance):
+        return instance.get('jitter', self.config['init_config'].get('jitter', self.interval(instance) / 10.0))
+
+    def reload_config(self):
+        try:
+            mtime = os.path.getmtime(config_path())
+            if mtime == self.config_mtime:
+                return
+            # A broken file is only reported once, the previous configuration is kept until it is fixed
+            self.config_mtime = mtime
+            config = load_config()
+            init_config = config['init_config']
+            api_host = init_config.get('api_host', DEFAULT_API_HOST)
+            primary_keys = (init_config['primary_api_key'], init_config['primary_app_key'], api_host)
+            instances = dict((instance['account_name'], instance) for instance in config['instances'])
+            clients = {}
+            for account_name, instance in instances.items():
+                keys = (instance['api_key'], instance['app_key'], instance.get('api_host', api_host))
+                current = self.clients.get(account_name)
+                clients[account_name] = current if current is not None and current[0] == keys else \
+                    (keys, org_client(account_name, keys, init_config))
+            metrics = config['metrics']
+        except (IOError, OSError, KeyError, TypeError, yaml.YAMLError) as e:
+            print("failed to load the configuration, keeping the previous one: " + repr(e))
+            return
+
+        if self.primary is None or self.primary[0] != primary_keys:
+            self.primary = (primary_keys, org_client('primary', primary_keys, init_config))
+        self.config = config
+        self.metrics = metrics
+        self.instances = instances
+        self.clients = clients
+        if self.state is not None:
+            with self.lock:
+                self.prune_watermarks()
+        now = time.time()
+        for account_name, instance in instances.items():
+            if account_name not in self.schedule:
+                # The first fetches of the orgs are spread over an interval
+                self.schedule[account_name] = now + random.uniform(0, self.interval(instance))
+        for account_name in list(self.schedule):
+            if account_name not in instances:
+                del self.schedule[account_name]
+                self.status.pop(account_name, None)
+        print("loaded the configuration of " + str(len(instances)) + " accounts")
+
+    def run(self):
+        self.reload_config()
+        if self.config is None:
+            raise SystemExit(1)
+        init_config = self.config['init_config']
+        self.state = load_state(state_path(self.config))
+        self.prune_watermarks()
+        start_rate_limit_telemetry(init_config)
+        self.queue = Queue(init_config.get('queue_size', QUEUE_SIZE))
+        self.pool = ThreadPool(init_config.get('max_concurrent_orgs', MAX_CONCURRENT_ORGS))
+        self.poster = threading.Thread(target=self.post_forever)
+        self.poster.daemon = True
+        self.poster.start()
+        if init_config.get('health_port'):
+            self.serve_health(init_config.get('health_host', 'localhost'), init_config['health_port'])
+
+        try:
+            while True:
+                self.reload_config()
+                now = time.time()
+                for account_name, next_fetch in sorted(self.schedule.items(), key=lambda item: item[1]):
+                    if next_fetch <= now and account_name not in self.in_flight:
+                        self.fetch(account_name, now)
+                time.sleep(SCHEDULER_TICK)
+        except KeyboardInterrupt:
+            # What was fetched and not posted yet is fetched again on the next start, its watermarks haven't moved
+            pass
+        finally:
+            self.pool.terminate()
+
+    def fetch(self, account_name, now):
+        instance = self.instances[account_name]
+        init_config = self.config['init_config']
+        # A fetch that took longer than the interval delays the next one, the watermarks catch up what was missed
+        next_fetch = self.schedule[account_name] + self.interval(instance)
+        if next_fetch <= now:
+            next_fetch = now + self.interval(instance)
+        jitter = self.jitter(instance)
+        self.schedule[account_name] = next_fetch + random.uniform(-jitter, jitter)
+
+        with self.lock:
+            self.in_flight.add(account_name)
+            watermarks = dict(self.state['watermarks'].get(account_name, {}))
+            queried_until = dict(self.state['queried_until'].get(account_name, {}))
+        end = int(now) - init_config.get('ingestion_delay', INGESTION_DELAY)
+        customer = (account_name, self.clients[account_name][1], self.metrics, watermarks, end, init_config,
+                    queried_until)
+        self.pool.apply_async(self.fetch_and_queue, (customer, self.primary[1]))
+
+    def fetch_and_queue(self, customer, primary_client):
+        # Runs on the pool, and blocks while the queue is full
+        try:
+            metric_data, error = fetch_customer_metrics(customer)
+        except Exception as e:
+            metric_data, error = None, e
+        self.queue.put((customer, metric_data, error, primary_client))
+
+    def post_forever(self):
+        while True:
+            # Whatever was fetched by the time the previous post is done is posted together
+            fetched = [self.queue.get()]
+            try:
+                while True:
+                    fetched.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self.post(fetched)
+            except Exception as e:
+                print("failed to post the metrics of " + str(len(fetched)) + " accounts: " + repr(e))
+            finally:
+                with self.lock:
+                    for customer, metric_data, error, primary_client in fetched:
+                        self.in_flight.discard(customer[0])
+
+    def post(self, fetched):
+        now = int(time.time())
+        init_config = fetched[-1][0][5]
+        primary_client = fetched[-1][3]
+        verify_interval = init_config.get('host_tag_verify_interval', HOST_TAG_VERIFY_INTERVAL)
+        host_tags = self.state['host_tags']
+
+        series_to_post = []
+        new_watermarks = {}
+        new_queried_until = {}
+        forwarded_until = {}
+        for customer, metric_data, error, _ in fetched:
+            customer_name, watermarks = customer[0], customer[3]
+            if error is not None:
+                print("failed to get metrics of account " + customer_name + ": " + str(error))
+                self.status.setdefault(customer_name, {})['last_error'] = str(error)
+                continue
+            new_watermarks[customer_name] = dict(watermarks)
+            forwarded_until[customer_name] = customer[4]
+            series = customer_series(customer_name, metric_data, watermarks, new_watermarks[customer_name])
+            new_queried_until[customer_name] = dict(customer[6])
+            move_queried_until(metric_data, customer[4], new_queried_until[customer_name])
+            for s in series:
+                tag_host(primary_client, host_tags, s['host'], customer_name, now, verify_interval)
+            series_to_post.extend(series)
+        if init_config.get('self_metrics', True):
+            series_to_post.extend(self.self_metrics(now))
+
+        payloads, failed = post_metrics(primary_client, init_config, series_to_post)
+        print("posted " + str(len(series_to_post)) + " series in " + str(payloads) + " payloads")
+        if failed:
+            print(str(failed) + " payloads failed, the watermarks are left unchanged")
+        else:
+            with self.lock:
+                self.state['watermarks'].update(new_watermarks)
+                self.state['queried_until'].update(new_queried_until)
+                # a fetch started before a reload may hold the watermarks of queries removed since
+                self.prune_watermarks()
+            for customer_name in new_watermarks:
+                self.status.setdefault(customer_name, {}).update({
+                    'last_forward': now, 'forwarded_until': forwarded_until[customer_name], 'last_error': None})
+        forget_old_hosts(host_tags, now, init_config.get('host_tag_retention', HOST_TAG_RETENTION))
+        save_state(state_path(self.config), self.state)
+
+    def prune_watermarks(self):
+        # The watermarks of queries no longer configured would never move again
+        queries = set(metric['metric'] for metric in self.metrics)
+        for watermarks in list(self.state['watermarks'].values()) + list(self.state['queried_until'].values()):
+            for query in list(watermarks):
+                if query not in queries:
+                    del watermarks[query]
+
+    def lag(self, account_name, now):
+        # Seconds since the end of the last window forwarded for the org, up to which every query was asked whether
+        # it had points or not. Until the org is first forwarded, since the oldest window end of its queries.
+        forwarded_until = self.status.get(account_name, {}).get('forwarded_until')
+        if forwarded_until is not None:
+            return now - forwarded_until
+        queried_until = self.state['queried_until'].get(account_name) or self.state['watermarks'].get(account_name)
+        if not queried_until:
+            return None
+        return now - min(queried_until.values())
+
+    def self_metrics(self, now):
+        series = [{'metric': 'cross_org_metric_broker.queue_depth', 'points': [[now, self.queue.qsize()]]},
+                  {'metric': 'cross_org_metric_broker.in_flight', 'points': [[now, len(self.in_flight)]]}]
+        for account_name in self.instances:
+            lag = self.lag(account_name, now)
+            if lag is not None:
+                series.append({'metric': 'cross_org_metric_broker.lag', 'points': [[now, lag]],
+                               'tags': ["customer:" + account_name]})
+        return series
+
+    def health(self):
+        # Unhealthy when the poster is dead or, with max_lag set, an org is more than max_lag seconds behind
+        now = time.time()
+        max_lag = self.config['init_config'].get('max_lag')
+        orgs = {}
+        healthy = self.poster.is_alive()
+        with self.lock:
+            for account_name in self.instances:
+                lag = self.lag(account_name, now)
+                status = dict(self.status.get(account_name, {}), lag=lag, next_fetch=self.schedule.get(account_name),
+                              in_flight=account_name in self.in_flight)
+                orgs[account_name] = status
+                if max_lag is not None and (lag is None or lag > max_lag):
+                    healthy = False
+        return healthy, {'healthy': healthy, 'queue_depth': self.queue.qsize(), 'queue_size': self.queue.maxsize,
+                         'orgs': orgs}
+
+    def serve_health(self, host, port):
+        daemon = self
 
-        metric_data = get_metrics(customer_key, metrics)
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                healthy, report = daemon.health()
+                body = json.dumps(report, sort_keys=True).encode('utf-8')
+                self.send_response(200 if healthy else 503)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
 
-        for payload in metric_data:
-            for series in payload['series']:
-                pointlist = convert_pointlist_to_seconds(list(series['pointlist']))
-                metric_name = str(series['expression'])
-                metric_name = metric_name.rpartition('{')[0]
-                hostname = series['scope']
+            def log_message(self, format, *args):
+                pass
 
-                print "account name: " + customer_name
-                print "metric name: " + metric_name
-                print "metric data: " + str(pointlist)
+        server = HTTPServer((host, port), HealthHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print("serving the health of the broker on http://" + host + ":" + str(server.server_port))
 
-                post_metrics(primary_key, customer_name, hostname, pointlist, metric_name)
-                add_host_tag(primary_key, hostname, customer_name)
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Forwards metrics of customer orgs to a primary org.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and forward each org on its own schedule instead of once')
+    args = parser.parse_args()
 
-process_metrics()
+    if args.daemon:
+        BrokerDaemon().run()
+    else:
+        process_metrics()
@@ -0,0 +1,225 @@
+'''
+         ____        __        ____
+        / __ \____ _/ /_____ _/ __ \____  ____ _
+       / / / / __ `/ __/ __ `/ / / / __ \/ __ `/
+      / /_/ / /_/ / /_/ /_/ / /_/ / /_/ / /_/ /
+     /_____/\__,_/\__/\__,_/_____/\____/\__, /
+                                       /____/
+'''
+
+import re
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from checks import AgentCheck #Datadog library for Custom Agent Check
+
+#Polls JSON endpoints and turns fields of their responses into metrics, the general form of weatherExample.py.
+#See http_json.yaml for the configuration.
+#
+#The endpoints of all the instances are fetched concurrently over one pooled session. A response is reused, without
+#asking the endpoint again, for the endpoint's ttl or for as long as its Cache-Control max-age allows; after that the
+#endpoint is asked with If-None-Match/If-Modified-Since, and an unchanged payload (304) isn't downloaded or parsed again.
+
+PATH_TOKEN_RE = re.compile(r"\.([^.\[\]]+)|\[(-?\d+|\*)\]|\['([^']*)'\]")
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+WILDCARD = object()
+
+def compile_path(path):
+    """Compiles a JSONPath-style path, such as $.current_observation.temp_f, $.disks[0].used, $.disks[*].used or
+    $['key.with.dots'], to a list of tokens: keys, list indexes and wildcards"""
+    if path.startswith('$'):
+        path = path[1:]
+    if path and not path.startswith(('.', '[')):
+        path = '.' + path
+    tokens = []
+    position = 0
+    while position < len(path):
+        match = PATH_TOKEN_RE.match(path, position)
+        if match is None:
+            raise Exception("Invalid path: {0}".format(path))
+        key, index, quoted_key = match.groups()
+        if key is not None:
+            tokens.append(key)
+        elif quoted_key is not None:
+            tokens.append(quoted_key)
+        elif index == '*':
+            tokens.append(WILDCARD)
+        else:
+            tokens.append(int(index))
+        position = match.end()
+    return tokens
+
+def find(document, tokens):
+    """Returns the (value, element) of each match of a compiled path, where element is the list item or object value
+    matched by the last wildcard of the path, or the document if there is none"""
+    matches = [(document, document)]
+    for token in tokens:
+        next_matches = []
+        for value, element in matches:
+            if token is WILDCARD:
+                if isinstance(value, list):
+                    next_matches.extend((item, item) for item in value)
+                elif isinstance(value, dict):
+                    next_matches.extend((item, item) for item in value.values())
+            elif isinstance(token, int):
+                if isinstance(value, list) and -len(value) <= token < len(value):
+                    next_matches.append((value[token], element))
+            elif isinstance(value, dict) and token in value:
+                next_matches.append((value[token], element))
+        matches = next_matches
+    return matches
+
+def to_number(value):
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class Endpoint(object):
+    """What is known about an endpoint between runs: its validators, how long its response stays fresh, and the
+    document it returned. The samples are extracted from the document on every run, by each endpoint config polling it
+    with its own metrics and tags."""
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.fresh_until = 0
+        self.document = None
+
+class HTTPJSONCheck(AgentCheck):
+    DEFAULT_MAX_WORKERS = 8
+    DEFAULT_TIMEOUT = 10
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self.max_workers = (init_config or {}).get('max_workers', self.DEFAULT_MAX_WORKERS)
+        self.pool = None
+        self.session = None
+        self.endpoints = {} #Endpoint by url and headers
+        self.paths = {} #compiled paths, by path
+
+    def check(self, instance):
+        endpoints = [self.get_endpoint_config(endpoint, instance) for endpoint in instance.get('endpoints', [])]
+        if not endpoints:
+            raise Exception("At least one endpoint must be specified in the instance")
+
+        if self.session is None:
+            self.session = requests.Session()
+            #one connection per worker and host, reused across runs
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.pool = ThreadPool(self.max_workers)
+
+        failed_endpoints = []
+        for endpoint, (samples, error) in zip(endpoints, self.pool.map(self.fetch, endpoints)):
+            if error is not None:
+                self.log.error("Failed to fetch {0} - {1}".format(endpoint['url'], error))
+                failed_endpoints.append(endpoint['url'])
+                continue
+            for name, metric_type, value, tags in samples:
+                if metric_type == 'rate':
+                    self.rate(name, value, tags=tags)
+                else:
+                    self.gauge(name, value, tags=tags) #Pass the metric to the Datadog agent
+
+        if failed_endpoints:
+            raise Exception("{0} of {1} endpoints failed, see the agent log: {2}".format(
+                len(failed_endpoints), len(endpoints), ", ".join(failed_endpoints)))
+
+    def get_endpoint_config(self, endpoint, instance):
+        if not endpoint.get('url'):
+            raise Exception("Each endpoint must have a url")
+        metrics = []
+        for metric in endpoint.get('metrics', []):
+            if not metric.get('path') or not metric.get('name'):
+                raise Exception("Each metric of endpoint {0} must have a path and a name".format(endpoint['url']))
+            if metric.get('type', 'gauge') not in ('gauge', 'rate'):
+                raise Exception("Unsupported metric type: {0}".format(metric.get('type')))
+            metrics.append({
+                'name': metric['name'],
+                'type': metric.get('type', 'gauge'),
+                'path': self.get_path(metric['path']),
+                'tags': metric.get('tags', []),
+                'tag_paths': [(tag, self.get_path(path)) for tag, path in sorted(metric.get('tag_paths', {}).items())],
+            })
+        headers = dict(instance.get('headers', {}), **endpoint.get('headers', {}))
+        return {
+            'url': endpoint['url'],
+            'headers': headers,
+            'key': (endpoint['url'], tuple(sorted(headers.items()))),
+            'timeout': endpoint.get('timeout', instance.get('timeout', self.DEFAULT_TIMEOUT)),
+            'ttl': endpoint.get('ttl', instance.get('ttl', 0)),
+            'tags': instance.get('tags', []) + endpoint.get('tags', []),
+            'metrics': metrics,
+        }
+
+    def get_path(self, path):
+        tokens = self.paths.get(path)
+        if tokens is None:
+            tokens = self.paths[path] = compile_path(path)
+        return tokens
+
+    def fetch(self, endpoint):
+        """Runs in a worker thread. Returns the samples of an endpoint, and an error or None."""
+        try:
+            state = self.endpoints.get(endpoint['key'])
+            if state is None:
+                state = self.endpoints[endpoint['key']] = Endpoint()
+            now = time.time()
+            if state.document is not None and now < state.fresh_until:
+                return self.extract(endpoint, state.document), None
+
+            headers = dict(endpoint['headers'])
+            if state.document is not None:
+                if state.etag:
+                    headers['If-None-Match'] = state.etag
+                if state.last_modified:
+                    headers['If-Modified-Since'] = state.last_modified
+            r = self.session.get(endpoint['url'], headers=headers, timeout=endpoint['timeout'])
+            if r.status_code == requests.codes.not_modified and state.document is not None:
+                document = state.document
+            elif r.status_code == requests.codes.ok: #ensure API response is sucessful (200)
+                document = r.json()
+                state.etag = r.headers.get('ETag')
+                state.last_modified = r.headers.get('Last-Modified')
+            else:
+                return None, "HTTP {0}".format(r.status_code)
+
+            state.document = document
+            state.fresh_until = now + max(endpoint['ttl'], self.max_age(r.headers))
+            return self.extract(endpoint, document), None
+        except Exception as e:
+            return None, e
+
+    def max_age(self, headers):
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+        match = MAX_AGE_RE.search(cache_control)
+        if match is None:
+            return 0
+        return int(match.group(1)) - int(headers.get('Age', 0) or 0)
+
+    def extract(self, endpoint, document):
+        samples = []
+        for metric in endpoint['metrics']:
+            for value, element in find(document, metric['path']):
+                value = to_number(value)
+                if value is None:
+                    continue
+                tags = endpoint['tags'] + metric['tags']
+                for tag, path in metric['tag_paths']:
+                    for tag_value, _ in find(element, path):
+                        tags = tags + ['{0}:{1}'.format(tag, tag_value)]
+                samples.append((metric['name'], metric['type'], value, tags))
+        return samples
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+        if self.session is not None:
+            self.session.close()
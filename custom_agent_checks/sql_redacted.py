@@ -7,26 +7,298 @@
                                        /____/
 '''
 
+import datetime
+import decimal
+import hashlib
+import json
+import os
+
 import pyodbc #pyodbc is included with the Datadog agent, so you should not have to install any additional libraries
 from checks import AgentCheck #Datadog library for Custom Agent Check
 
+#Runs the queries of each instance (see sql_redacted.yaml) and turns every row into metrics, tagged with the row's tag columns.
+#The connection to the database is kept across runs and only reopened when it stops answering.
+#A query with a watermark_column only reads the rows added since the previous run, see run_incremental_query.
 class SQL_query(AgentCheck):
+   DEFAULT_DRIVER = 'SQL Server'
+   DEFAULT_BATCH_SIZE = 1000 #rows fetched per round trip
+   DEFAULT_TIMEOUT = 30 #seconds a query may run
+   DEFAULT_CONNECT_TIMEOUT = 15
+   HEALTH_CHECK_TIMEOUT = 5
+   COLUMN_TYPES = ('tag', 'gauge', 'rate', 'ignore')
+   AGGREGATES = ('sum', 'count', 'min', 'max', 'avg')
+   WATERMARK_ALIAS = 'dd_watermark'
+   DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+   def __init__(self, name, init_config, agentConfig, instances=None):
+      AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+      self.connections = {} #open connections, by connection string
+      self.watermarks = None #last watermark of each incremental query, loaded on first use
+
    def check(self, instance):
-      server = 'tcp:127.0.0.1' #put Database connection path here
-      database = 'DatadogDB' # put Database name here
-      username = 'ddagent' # put Database username here
-      password = '9IeP4mB0btF1G346UskTCoMh' # put Database Password here
+      connection_string = self.get_connection_string(instance)
+      queries = [self.get_query_config(query, instance) for query in instance.get('queries', [])]
+      if not queries:
+         raise Exception("At least one query must be specified in the instance")
+
+      cnxn = self.get_connection(connection_string, instance.get('connect_timeout', self.DEFAULT_CONNECT_TIMEOUT))
+      failed_queries = []
+      for query in queries:
+         try:
+            if query['watermark_column']:
+               self.run_incremental_query(cnxn, query, connection_string)
+            else:
+               self.run_query(cnxn, query)
+         except Exception as e: #database errors, and queries not returning the columns configured for them
+            self.log.error("Query failed: {0} - {1}".format(query['query'], e))
+            failed_queries.append(query['query'])
+            if isinstance(e, pyodbc.Error) and not self.is_healthy(cnxn): #the connection is gone, the remaining queries get a new one
+               self.close_connection(connection_string)
+               cnxn = self.get_connection(connection_string, instance.get('connect_timeout', self.DEFAULT_CONNECT_TIMEOUT))
+
+      if failed_queries:
+         raise Exception("{0} of {1} queries failed, see the agent log: {2}".format(
+            len(failed_queries), len(queries), "; ".join(failed_queries)))
+
+   def get_connection_string(self, instance):
+      if instance.get('connection_string'):
+         return instance['connection_string']
+      server = instance.get('server') #put Database connection path here, e.g. tcp:127.0.0.1
+      database = instance.get('database') #put Database name here
+      if not server or not database:
+         raise Exception("Either a connection_string or a server and a database must be specified in the instance")
+      connection_string = 'DRIVER={' + instance.get('driver', self.DEFAULT_DRIVER) + '};SERVER=' + server + ';DATABASE=' + database
+      if instance.get('username'):
+         connection_string += ';UID=' + instance['username'] + ';PWD=' + instance.get('password', '')
+      else:
+         connection_string += ';Trusted_Connection=yes' #Windows authentication
+      return connection_string
 
-      cnxn = pyodbc.connect('DRIVER={SQL Server};SERVER='+server+';DATABASE='+database+';UID='+username+';PWD='+ password)
+   def get_query_config(self, query, instance):
+      if not query.get('query'):
+         raise Exception("Each query must have a query")
+      columns = query.get('columns', [])
+      for column in columns:
+         if column.get('type', 'gauge') not in self.COLUMN_TYPES:
+            raise Exception("Unsupported column type: {0}".format(column.get('type')))
+         if column.get('type', 'gauge') != 'ignore' and not column.get('name'):
+            raise Exception("Each column of query {0} must have a name".format(query['query']))
+      if query.get('watermark_column') and not hasattr(self, 'read_persistent_cache') and not self.init_config.get('watermark_directory'):
+         #no default: in a directory wiped on reboot, like the temporary directory, the rows added while the host was down would be skipped
+         raise Exception("Query {0} has a watermark_column, which needs a watermark_directory in init_config on agents without a persistent cache".format(
+            query['query']))
+      aggregated = [column for column in columns if column.get('aggregate')]
+      if aggregated:
+         if not query.get('watermark_column'):
+            raise Exception("Query {0} aggregates columns but has no watermark_column".format(query['query']))
+         for column in columns:
+            if column.get('type', 'gauge') in ('gauge', 'rate') and (column.get('aggregate') not in self.AGGREGATES or not column.get('column')):
+               raise Exception("When aggregating, each metric column of query {0} needs a column and an aggregate, one of {1}".format(
+                  query['query'], ", ".join(self.AGGREGATES)))
+      return {
+         'query': query['query'],
+         'watermark_column': query.get('watermark_column'),
+         'aggregate': bool(aggregated),
+         'initial_watermark': query.get('initial_watermark'),
+         'columns': columns,
+         #column positions are worked out once per query rather than once per row
+         'tag_columns': [(index, column['name']) for index, column in enumerate(columns) if column.get('type') == 'tag'],
+         'metric_columns': [(index, column['name'], column.get('type', 'gauge')) for index, column in enumerate(columns)
+                            if column.get('type', 'gauge') in ('gauge', 'rate')],
+         'tags': instance.get('tags', []) + query.get('tags', []),
+         'timeout': query.get('timeout', instance.get('timeout', self.DEFAULT_TIMEOUT)),
+         'batch_size': query.get('batch_size', instance.get('batch_size', self.DEFAULT_BATCH_SIZE)),
+      }
+
+   def get_connection(self, connection_string, connect_timeout):
+      cnxn = self.connections.get(connection_string)
+      if cnxn is not None:
+         if self.is_healthy(cnxn):
+            return cnxn
+         self.log.warning("Database connection isn't answering, reconnecting")
+         self.close_connection(connection_string)
+      cnxn = pyodbc.connect(connection_string, timeout=connect_timeout)
+      self.connections[connection_string] = cnxn
+      return cnxn
+
+   def is_healthy(self, cnxn):
+      try:
+         cnxn.timeout = self.HEALTH_CHECK_TIMEOUT
+         cursor = cnxn.cursor()
+         try:
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+         finally:
+            cursor.close()
+         return True
+      except pyodbc.Error:
+         return False
+
+   def close_connection(self, connection_string):
+      cnxn = self.connections.pop(connection_string, None)
+      if cnxn is not None:
+         try:
+            cnxn.close()
+         except pyodbc.Error:
+            pass
+
+   def run_query(self, cnxn, query, params=(), watermark_column=None):
+      """Submits the rows of a query. Returns the largest value of watermark_column, if given."""
+      cnxn.timeout = query['timeout'] #applies to the statements executed from now on
       cursor = cnxn.cursor()
-      #Sample select query
-      cursor.execute("SELECT * FROM dbo.Products;") #What to query?
-      row = cursor.fetchone() #iterate through until you hit the end of table
-      while row:
-          dd_tags = [   #set datadog tags
-            'ProductName:' + row[1],
-            'ProductDescription:' + row[3],
-          ]
-          self.gauge('sqlserver.product.price', row[2], tags=dd_tags) #Set metric name and tags, and pass to Datadog agent
-          row = cursor.fetchone()
-      cnxn.close() #close connection
+      watermark = None
+      try:
+         cursor.execute(query['query'], *params)
+         if len(cursor.description) != len(query['columns']):
+            raise Exception("Query {0} returns {1} columns but {2} are configured".format(
+               query['query'], len(cursor.description), len(query['columns'])))
+         watermark_index = None
+         if watermark_column:
+            watermark_index = self.column_index(cursor, watermark_column, query)
+         while True:
+            rows = cursor.fetchmany(query['batch_size']) #fetch a batch of rows per round trip instead of one
+            if not rows:
+               break
+            for row in rows:
+               self.submit_row(row, query)
+               if watermark_index is not None and row[watermark_index] is not None and (watermark is None or row[watermark_index] > watermark):
+                  watermark = row[watermark_index]
+      finally:
+         cursor.close()
+      return watermark
+
+   def column_index(self, cursor, name, query):
+      names = [description[0].lower() for description in cursor.description]
+      if name.lower() not in names:
+         raise Exception("Query {0} doesn't return its watermark_column {1}".format(query['query'], name))
+      return names.index(name.lower())
+
+   def run_incremental_query(self, cnxn, query, connection_string):
+      """Runs a query over an append-only table, where watermark_column only ever increases, so that each run only
+      reads the rows added since the previous one: the query is wrapped in a SELECT keeping the rows with a watermark
+      greater than the last one seen. With aggregates, the rows are also grouped by the tag columns by the database,
+      so that a run submits one row per group rather than every new row.
+
+      The last watermark is persisted, in the agent's cache when the agent has one. A query that has none yet starts
+      from its initial_watermark, or else from the current largest watermark without submitting anything, so that
+      adding a query doesn't read the whole table.
+      """
+      key = hashlib.md5((connection_string + '\n' + query['query'] + '\n' + query['watermark_column']).encode('utf-8')).hexdigest()
+      watermark = self.get_watermark(key)
+      if watermark is None:
+         watermark = query['initial_watermark']
+      source = query['query'].strip().rstrip(';')
+      watermark_column = query['watermark_column']
+
+      if watermark is None:
+         cnxn.timeout = query['timeout']
+         cursor = cnxn.cursor()
+         try:
+            cursor.execute('SELECT MAX({0}) FROM ({1}) AS incremental;'.format(watermark_column, source))
+            watermark = cursor.fetchone()[0]
+         finally:
+            cursor.close()
+         if watermark is not None:
+            self.set_watermark(key, watermark)
+         return
+
+      if query['aggregate']:
+         #only the tag and metric columns are selected, in the order they are configured, followed by the watermark
+         tag_columns = [column for column in query['columns'] if column.get('type') == 'tag']
+         metric_columns = [column for column in query['columns'] if column.get('type', 'gauge') in ('gauge', 'rate')]
+         group_by = [column.get('column', column['name']) for column in tag_columns]
+         selected = group_by + ['{0}({1})'.format(column['aggregate'].upper(), column['column']) for column in metric_columns]
+         selected.append('MAX({0}) AS {1}'.format(watermark_column, self.WATERMARK_ALIAS))
+         sql = 'SELECT {0} FROM ({1}) AS incremental WHERE {2} > ?'.format(', '.join(selected), source, watermark_column)
+         if group_by:
+            sql += ' GROUP BY ' + ', '.join(group_by)
+         columns = tag_columns + metric_columns + [{'type': 'ignore'}]
+         incremental = dict(query, query=sql + ';', columns=columns,
+                            tag_columns=[(index, column['name']) for index, column in enumerate(tag_columns)],
+                            metric_columns=[(len(tag_columns) + index, column['name'], column.get('type', 'gauge'))
+                                            for index, column in enumerate(metric_columns)])
+         latest = self.run_query(cnxn, incremental, (watermark,), self.WATERMARK_ALIAS)
+      else:
+         sql = 'SELECT * FROM ({0}) AS incremental WHERE {1} > ?;'.format(source, watermark_column)
+         latest = self.run_query(cnxn, dict(query, query=sql), (watermark,), watermark_column)
+
+      if latest is not None and latest > watermark:
+         self.set_watermark(key, latest)
+
+   def get_watermark(self, key):
+      if self.watermarks is None:
+         self.watermarks = {}
+         if not hasattr(self, 'read_persistent_cache'):
+            try:
+               with open(self.watermark_path()) as watermark_file:
+                  self.watermarks = json.load(watermark_file)
+            except (IOError, OSError, ValueError):
+               pass
+      if key not in self.watermarks and hasattr(self, 'read_persistent_cache'):
+         stored = self.read_persistent_cache(key)
+         if stored:
+            self.watermarks[key] = json.loads(stored)
+      if key not in self.watermarks:
+         return None
+      return self.decode_watermark(self.watermarks[key])
+
+   def set_watermark(self, key, watermark):
+      self.watermarks[key] = self.encode_watermark(watermark)
+      if hasattr(self, 'write_persistent_cache'):
+         self.write_persistent_cache(key, json.dumps(self.watermarks[key]))
+         return
+      #agents without a persistent cache: all the watermarks of the check in a file, replaced atomically
+      path = self.watermark_path()
+      with open(path + '.tmp', 'w') as watermark_file:
+         json.dump(self.watermarks, watermark_file)
+      if os.name == 'nt' and os.path.exists(path):
+         os.remove(path)
+      os.rename(path + '.tmp', path)
+
+   def watermark_path(self):
+      return os.path.join(self.init_config['watermark_directory'], 'sql_redacted_watermarks.json')
+
+   def encode_watermark(self, watermark):
+      #the type is kept so that the watermark is given back to the database as the same type
+      if isinstance(watermark, datetime.datetime):
+         return ['datetime', watermark.strftime(self.DATETIME_FORMAT)]
+      if isinstance(watermark, datetime.date):
+         return ['date', watermark.strftime('%Y-%m-%d')]
+      if isinstance(watermark, decimal.Decimal):
+         return ['decimal', str(watermark)]
+      if isinstance(watermark, float):
+         return ['float', repr(watermark)]
+      if isinstance(watermark, bool) or not isinstance(watermark, (int, type(2 ** 64))):
+         return ['str', watermark if isinstance(watermark, type(u'')) else str(watermark)]
+      return ['int', str(watermark)]
+
+   def decode_watermark(self, encoded):
+      watermark_type, value = encoded
+      if watermark_type == 'datetime':
+         return datetime.datetime.strptime(value, self.DATETIME_FORMAT)
+      if watermark_type == 'date':
+         return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+      if watermark_type == 'decimal':
+         return decimal.Decimal(value)
+      if watermark_type == 'float':
+         return float(value)
+      if watermark_type == 'int':
+         return int(value)
+      return value
+
+   def submit_row(self, row, query):
+      dd_tags = query['tags'] + [ #set datadog tags
+         '{0}:{1}'.format(name, row[index]) for index, name in query['tag_columns'] if row[index] is not None
+      ]
+      for index, name, metric_type in query['metric_columns']:
+         value = row[index]
+         if value is None:
+            continue
+         if metric_type == 'rate':
+            self.rate(name, float(value), tags=dd_tags)
+         else:
+            self.gauge(name, float(value), tags=dd_tags) #Set metric name and tags, and pass to Datadog agent
+
+   def stop(self):
+      for connection_string in list(self.connections):
+         self.close_connection(connection_string)
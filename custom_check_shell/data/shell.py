@@ -2,41 +2,211 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 
+# stdlib
+import json
+import re
+import shlex
+import subprocess
+import threading
+import time
+
 # project
 from checks import AgentCheck
 from utils.subprocess_output import get_subprocess_output
 
+try:
+    basestring_types = basestring
+except NameError:
+    basestring_types = str
+
+class StreamedCommand(object):
+    """A command that is started once and kept running, for mode: stream.
+
+    A background thread reads the samples the command prints, one line at a time, and aggregates them until the check
+    drains them. The command is restarted when it exits, after a delay that doubles each time it exits again without
+    having printed a sample, up to max_restart_backoff.
+    """
+
+    def __init__(self, args, parse, log, restart_backoff, max_restart_backoff):
+        self.args = args
+        self.parse = parse
+        self.log = log
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.backoff = restart_backoff
+        self.next_start = 0
+        self.process = None
+        self.received = False
+        self.lock = threading.Lock()
+        # (name, tags, type) -> [last, count, sum, min, max] of the samples read since the last drain
+        self.aggregates = {}
+
+    def ensure_running(self, now):
+        """Starts the command if it isn't running and is due to be (re)started.
+        Returns a message if the command isn't running, None if it is.
+        """
+        if self.process is not None:
+            returncode = self.process.poll()
+            if returncode is None:
+                return None
+            self.process = None
+            return self.schedule_restart(now, "Command exited with code {0}".format(returncode))
+
+        if now < self.next_start:
+            return "Command isn't running, restarting in {0:.1f} seconds".format(self.next_start - now)
+
+        self.received = False
+        try:
+            process = subprocess.Popen(self.args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        except OSError as e:
+            return self.schedule_restart(now, "Command failed to start: {0}".format(e))
+        for target, stream in ((self.read_samples, process.stdout), (self.read_errors, process.stderr)):
+            reader = threading.Thread(target=target, args=(stream,))
+            reader.daemon = True
+            reader.start()
+        self.process = process
+        return None
+
+    def schedule_restart(self, now, reason):
+        # A command that printed samples before exiting is restarted quickly, one that keeps failing less and less often
+        if self.received:
+            self.backoff = self.restart_backoff
+        delay = self.backoff
+        self.backoff = min(self.backoff * 2, self.max_restart_backoff)
+        self.next_start = now + delay
+        return "{0}, restarting in {1:.1f} seconds".format(reason, delay)
+
+    def read_samples(self, stdout):
+        for line in iter(stdout.readline, b''):
+            try:
+                samples = self.parse(line.decode('utf-8', 'replace'))
+            except Exception as e:
+                self.log.warning("Skipping line of streamed command output: {0}".format(e))
+                continue
+            with self.lock:
+                for name, value, tags, metric_type in samples:
+                    self.received = True
+                    key = (name, tuple(tags), metric_type)
+                    aggregate = self.aggregates.get(key)
+                    if aggregate is None:
+                        self.aggregates[key] = [value, 1, value, value, value]
+                    else:
+                        aggregate[0] = value
+                        aggregate[1] += 1
+                        aggregate[2] += value
+                        aggregate[3] = min(aggregate[3], value)
+                        aggregate[4] = max(aggregate[4], value)
+        stdout.close()
+
+    def read_errors(self, stderr):
+        for line in iter(stderr.readline, b''):
+            self.log.debug("Streamed command wrote to stderr: {0}".format(line.decode('utf-8', 'replace').rstrip()))
+        stderr.close()
+
+    def drain(self, aggregation):
+        """Returns the (name, value, tags, type) of the samples read since the last drain, one per name, tags and type"""
+        with self.lock:
+            aggregates, self.aggregates = self.aggregates, {}
+        samples = []
+        for (name, tags, metric_type), (last, count, total, minimum, maximum) in aggregates.items():
+            if aggregation == "last":
+                value = last
+            elif aggregation == "avg":
+                value = total / count
+            elif aggregation == "sum":
+                value = total
+            elif aggregation == "min":
+                value = minimum
+            else:
+                value = maximum
+            samples.append((name, value, list(tags), metric_type))
+        return samples
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process = None
+
 class ShellCheck(AgentCheck):
     """This check provides metrics from a shell command
 
+    By default the command prints a single number. With output_format "lines" or "json" one run of the command can
+    report many metrics instead, see parse_lines and parse_json. With mode "stream" the command is started once and
+    kept running, and prints its samples as they come, see StreamedCommand.
+
     WARNING: the user that dd-agent runs may need sudo access for the shell command
              sudo access is not required when running dd-agent as root (not recommended)
     """
 
     METRIC_NAME_PREFIX = "shell"
+    OUTPUT_FORMATS = ("single", "lines", "json")
+    METRIC_TYPES = ("gauge", "rate")
+    MODES = ("run", "stream")
+    AGGREGATIONS = ("last", "avg", "sum", "min", "max")
+    # Metric names start with a letter and only contain alphanumerics, underscores and periods
+    METRIC_NAME_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_.]*$")
+    MAX_METRIC_NAME_LENGTH = 200
+    # Commands print the same names on every run, so each name is only validated once. The cache is bounded in case a
+    # command prints something like a timestamp in its names.
+    METRIC_NAME_CACHE_SIZE = 10000
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self.metric_names = {}
+        # Commands of mode: stream, by command and metric_name
+        self.streams = {}
 
     def get_instance_config(self, instance):
         command = instance.get('command', None)
         metric_name = instance.get('metric_name', None)
         metric_type = instance.get('metric_type', 'gauge')
+        output_format = instance.get('output_format', 'single')
+        mode = instance.get('mode', 'run')
+        aggregation = instance.get('aggregation', 'last')
         tags = instance.get('tags', [])
 
         if command is None:
             raise Exception("A command must be specified in the instance")
 
-        if metric_name is None:
+        if output_format not in self.OUTPUT_FORMATS:
+            message = "Unsupported output_format: {0}".format(output_format)
+            raise Exception(message)
+
+        # With the lines and json output formats, metric_name is an optional prefix of the names the command prints
+        if metric_name is None and output_format == "single":
             raise Exception("A metric_name must be specified in the instance")
 
-        if metric_type != "gauge" and metric_type != "rate":
+        if metric_type not in self.METRIC_TYPES:
             message = "Unsupported metric_type: {0}".format(metric_type)
             raise Exception(message)
 
-        metric_name = "{0}.{1}".format(self.METRIC_NAME_PREFIX, metric_name)
+        if mode not in self.MODES:
+            message = "Unsupported mode: {0}".format(mode)
+            raise Exception(message)
+
+        if aggregation not in self.AGGREGATIONS:
+            message = "Unsupported aggregation: {0}".format(aggregation)
+            raise Exception(message)
+
+        if metric_name is None:
+            metric_name = self.METRIC_NAME_PREFIX
+        else:
+            metric_name = "{0}.{1}".format(self.METRIC_NAME_PREFIX, metric_name)
 
         config = {
             "command": command,
             "metric_name": metric_name,
             "metric_type": metric_type,
+            "output_format": output_format,
+            "mode": mode,
+            "aggregation": aggregation,
+            "restart_backoff": instance.get('restart_backoff', 1),
+            "max_restart_backoff": instance.get('max_restart_backoff', 300),
             "tags": tags
         }
 
@@ -47,17 +217,165 @@ class ShellCheck(AgentCheck):
         command = config.get("command")
         metric_name = config.get("metric_name")
         metric_type = config.get("metric_type")
+        output_format = config.get("output_format")
         tags = config.get("tags")
 
+        if config.get("mode") == "stream":
+            self.check_stream(config)
+            return
+
         output, _, _ = get_subprocess_output(command, self.log, True)
 
-        try:
-            metric_value = float(output)
-        except (TypeError, ValueError):
-            raise Exception("Command must output a number.")
+        if output_format == "single":
+            try:
+                metric_value = float(output)
+            except (TypeError, ValueError):
+                raise Exception("Command must output a number.")
+            self.submit(metric_type, metric_name, metric_value, tags)
+            return
+
+        if output_format == "lines":
+            samples = self.parse_lines(output)
+        else:
+            samples = self.parse_json(output)
+
+        for name, value, sample_tags, sample_type in samples:
+            full_name = self.get_metric_name(metric_name, name)
+            if full_name is None:
+                continue
+            self.submit(sample_type or metric_type, full_name, value, tags + sample_tags)
+
+    def check_stream(self, config):
+        command = config.get("command")
+        metric_name = config.get("metric_name")
+        output_format = config.get("output_format")
+        tags = config.get("tags")
+
+        args = shlex.split(command) if isinstance(command, basestring_types) else list(command)
+        key = (tuple(args), metric_name)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = StreamedCommand(
+                args, lambda line: self.parse_stream_line(output_format, line), self.log,
+                config.get("restart_backoff"), config.get("max_restart_backoff"))
+
+        error = stream.ensure_running(time.time())
+        # Samples read before the command exited are still submitted
+        for name, value, sample_tags, sample_type in stream.drain(config.get("aggregation")):
+            if name is None:
+                full_name = metric_name
+            else:
+                full_name = self.get_metric_name(metric_name, name)
+                if full_name is None:
+                    continue
+            self.submit(sample_type or config.get("metric_type"), full_name, value, tags + sample_tags)
 
+        if error is not None:
+            raise Exception(error)
+
+    def parse_stream_line(self, output_format, line):
+        """Parse a line printed by a command of mode: stream, where each line is a number, a line of the lines output
+        format, or a JSON document"""
+        if not line.strip():
+            return []
+        if output_format == "single":
+            try:
+                return [(None, float(line), [], None)]
+            except ValueError:
+                raise Exception("Command must output a number per line.")
+        if output_format == "lines":
+            return self.parse_lines(line)
+        return self.parse_json(line)
+
+    def stop(self):
+        for stream in self.streams.values():
+            stream.stop()
+
+    def submit(self, metric_type, metric_name, value, tags):
         if metric_type == "gauge":
-            self.gauge(metric_name, metric_value, tags=tags)
+            self.gauge(metric_name, value, tags=tags)
 
         else:
-            self.rate(metric_name, metric_value, tags=tags)
+            self.rate(metric_name, value, tags=tags)
+
+    def parse_lines(self, output):
+        """Parse one metric per line, as `name value [tag:val,...] [gauge|rate]`.
+        Returns (name, value, tags, metric type or None) tuples. Malformed lines are skipped.
+        """
+        samples = []
+        for line in output.splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            metric_type = None
+            if len(fields) > 2 and fields[-1] in self.METRIC_TYPES:
+                metric_type = fields.pop()
+            if len(fields) not in (2, 3):
+                self.log.warning("Skipping malformed line in command output: {0!r}".format(line))
+                continue
+            try:
+                value = float(fields[1])
+            except ValueError:
+                self.log.warning("Skipping line with a value that isn't a number: {0!r}".format(line))
+                continue
+            sample_tags = fields[2].split(",") if len(fields) == 3 else []
+            samples.append((fields[0], value, sample_tags, metric_type))
+        return samples
+
+    def parse_json(self, output):
+        """Parse either an object mapping names to values, or a list of objects with a name, a value, and optionally
+        a list of tags and a type.
+        Returns (name, value, tags, metric type or None) tuples. Malformed metrics are skipped.
+        """
+        try:
+            document = json.loads(output)
+        except (TypeError, ValueError):
+            raise Exception("Command must output JSON.")
+
+        if isinstance(document, dict):
+            document = [{"name": name, "value": value} for name, value in document.items()]
+        if not isinstance(document, list):
+            raise Exception("Command must output a JSON object or list.")
+
+        samples = []
+        for metric in document:
+            try:
+                name = metric["name"]
+                value = float(metric["value"])
+                sample_tags = metric.get("tags", [])
+                metric_type = metric.get("type")
+            except (AttributeError, KeyError, TypeError, ValueError):
+                self.log.warning("Skipping malformed metric in command output: {0!r}".format(metric))
+                continue
+            if not isinstance(name, type(u"")):
+                self.log.warning("Skipping metric with a name that isn't a string: {0!r}".format(metric))
+                continue
+            if metric_type is not None and metric_type not in self.METRIC_TYPES:
+                self.log.warning("Skipping metric with an unsupported type: {0!r}".format(metric))
+                continue
+            # A single tag may be given as a string rather than as a list of one
+            if isinstance(sample_tags, basestring_types):
+                sample_tags = [sample_tags]
+            elif not isinstance(sample_tags, list):
+                self.log.warning("Skipping metric with tags that aren't a list: {0!r}".format(metric))
+                continue
+            samples.append((name, value, list(sample_tags), metric_type))
+        return samples
+
+    def get_metric_name(self, prefix, name):
+        """Returns the full name of a metric printed by the command, or None if it isn't a valid metric name"""
+        key = (prefix, name)
+        try:
+            return self.metric_names[key]
+        except KeyError:
+            pass
+
+        full_name = "{0}.{1}".format(prefix, name)
+        if not self.METRIC_NAME_RE.match(name) or len(full_name) > self.MAX_METRIC_NAME_LENGTH:
+            self.log.warning("Skipping invalid metric name: {0!r}".format(name))
+            full_name = None
+
+        if len(self.metric_names) >= self.METRIC_NAME_CACHE_SIZE:
+            self.metric_names.clear()
+        self.metric_names[key] = full_name
+        return full_name
@@ -0,0 +1,17 @@
+#!/bin/sh
+# Prints vmstat's columns every second as "<name> <value>" lines, for the mode: stream example of shell.yaml.
+# vmstat's own output can't be streamed as is: its header rows and unnamed columns aren't in the lines format.
+# stdbuf has vmstat write each row as it comes rather than when its buffer to the pipe is full.
+stdbuf -oL vmstat -n 1 | while read running blocked swpd free buff cache si so bi bo interrupts cs user system idle wait stolen; do
+    # Header rows
+    case "$running" in
+        *[!0-9]*) continue ;;
+    esac
+    echo "procs.running $running"
+    echo "procs.blocked $blocked"
+    echo "memory.free $((free * 1024))"
+    echo "cpu.user $user"
+    echo "cpu.system $system"
+    echo "cpu.idle $idle"
+    echo "cpu.wait $wait"
+done
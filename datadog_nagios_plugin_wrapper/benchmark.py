@@ -0,0 +1,133 @@
+"""
+Micro-benchmark for the perfdata parsing of the Nagios plugin wrapper.
+
+Generates the output of a plugin reporting many labels, with quoted labels, threshold ranges and perfdata spread over
+the long output lines, and reports how fast NagiosPluginWrapperCheck turns it into metrics. Only the parsing is timed,
+no plugin is run. To compare a change before and after, run the benchmark against both versions of the check:
+
+    git show HEAD~1:datadog_nagios_plugin_wrapper/checks.d/nagios_plugin_wrapper.py > /tmp/wrapper_before.py
+    python benchmark.py --labels 500 --check /tmp/wrapper_before.py
+    python benchmark.py --labels 500
+
+The agent doesn't need to be installed, but six does.
+"""
+
+import json
+import os.path
+import random
+import sys
+import timeit
+import types
+
+from argparse import ArgumentParser
+
+class CheckException(Exception):
+    pass
+
+class AgentCheck(object):
+    """ Just enough of the datadog_checks.base AgentCheck to parse plugin output. """
+    OK, WARNING, CRITICAL, UNKNOWN = range(4)
+
+    def __init__(self, name, init_config, instances=None):
+        self.name = name
+        self.init_config = init_config
+        self.instances = instances or []
+        self.log = _NullLog()
+
+class _NullLog(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def load_check_module(path):
+    """ Loads nagios_plugin_wrapper.py with stub datadog_checks modules in place of the agent's. """
+    datadog_checks = types.ModuleType('datadog_checks')
+    base = types.ModuleType('datadog_checks.base')
+    base.AgentCheck = AgentCheck
+    errors = types.ModuleType('datadog_checks.base.errors')
+    errors.CheckException = CheckException
+    sys.modules.update({'datadog_checks': datadog_checks, 'datadog_checks.base': base,
+                        'datadog_checks.base.errors': errors})
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source('wrapper_under_benchmark', path)
+    spec = spec_from_file_location('wrapper_under_benchmark', path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def generate_output(rng, labels, quoted, lines):
+    """ Returns the output of a plugin reporting the given number of labels, a fraction of them quoted, with its
+    perfdata spread over the given number of lines. """
+    items = []
+    for number in range(labels):
+        if rng.random() < quoted:
+            label = "'volume {0} used'".format(number)
+        else:
+            label = 'volume_{0}_used'.format(number)
+        unit = rng.choice(['', '%', 'B', 'KB', 'MB', 'ms', 's', 'c'])
+        items.append('{0}={1}{2};{3}:;@{4}:{5};0;{6}'.format(
+            label, rng.randint(0, 10000), unit, rng.randint(0, 100), rng.randint(100, 200), rng.randint(200, 300),
+            rng.randint(10000, 20000)))
+
+    per_line = max(1, -(-labels // lines))
+    chunks = [' '.join(items[start:start + per_line]) for start in range(0, labels, per_line)]
+    output = ['DISK OK - {0} volumes checked | {1}'.format(labels, chunks[0])]
+    if len(chunks) > 1:
+        output.append('All volumes are below their thresholds | {0}'.format(chunks[1]))
+        output.extend(chunks[2:])
+    return '\n'.join(output)
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    check_module = load_check_module(args.check)
+    check = check_module.NagiosPluginWrapperCheck('nagios_plugin_wrapper', {}, [{}])
+    command = {'check_command': 'check_disk', 'metric_namespace': 'nagios.check_disk', 'tags': [],
+               'create_service_check': True, 'timeout': 60}
+    output = generate_output(rng, args.labels, args.quoted, args.lines)
+
+    gauges, service_check = check._parse_result(command, output, 0, False)
+    timer = timeit.Timer(lambda: check._parse_result(command, output, 0, False))
+    # Each repeat is a batch of runs, as many as fit in about a tenth of a second, and the best batch is reported.
+    batch = max(1, int(0.1 / max(timer.timeit(1), 1e-9)))
+    best = min(timer.repeat(repeat=args.repeat, number=batch)) / batch
+    return {
+        'check': os.path.abspath(args.check),
+        'labels': args.labels,
+        'quoted': args.quoted,
+        'lines': args.lines,
+        'output_bytes': len(output),
+        'metrics_parsed': len(gauges),
+        'parse_us': best * 1000000,
+        'outputs_per_second': 1 / best,
+        'labels_per_second': args.labels / best,
+    }
+
+def print_report(report):
+    print("check:              {0}".format(report['check']))
+    print("output:             {0} labels ({1:.0%} quoted) on {2} lines, {3} bytes".format(
+        report['labels'], report['quoted'], report['lines'], report['output_bytes']))
+    print("metrics parsed:     {0}".format(report['metrics_parsed']))
+    print("parse time:         {0:.1f} us".format(report['parse_us']))
+    print("throughput:         {0:.0f} outputs/s, {1:.0f} labels/s".format(
+        report['outputs_per_second'], report['labels_per_second']))
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = ArgumentParser(description='Benchmark the perfdata parsing of the Nagios plugin wrapper.')
+    parser.add_argument('--check', default=os.path.join(here, 'checks.d', 'nagios_plugin_wrapper.py'),
+                        help='Path to the nagios_plugin_wrapper.py to benchmark (default: the one in checks.d)')
+    parser.add_argument('--labels', type=int, default=300, help='Number of labels in the plugin output')
+    parser.add_argument('--quoted', type=float, default=0.2, help='Fraction of the labels that are quoted')
+    parser.add_argument('--lines', type=int, default=1, help='Number of lines the perfdata is spread over')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed batches, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the output generator')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
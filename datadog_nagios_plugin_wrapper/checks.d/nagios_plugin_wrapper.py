@@ -1,52 +1,366 @@
+import json
+import logging
+import os
 import re
+import signal
+import string
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from six import PY3, string_types
 from datadog_checks.base import AgentCheck
 from datadog_checks.base.errors import CheckException
-from datadog_checks.utils.subprocess_output import get_subprocess_output
 
-__version__ = "1.0.0"
+__version__ = "1.4.0"
 __author__ = "Misiu Pajor <misiu.pajor@datadoghq.com>"
 
+# Source of the worker process of the inprocess runner. It reads one JSON request per line on stdin, runs the plugin in
+# its own interpreter with sys.argv, sys.stdout and sys.stderr set as if the plugin had been started on its own, and
+# answers on stdout with the output and the exit code the plugin's process would have had. Plugin modules are loaded
+# once, and again only when their file changes.
+INPROCESS_WORKER = r"""
+import json
+import os
+import runpy
+import sys
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    import imp
+    spec_from_file_location = None
+
+# Answers go to the original stdout, whatever a plugin writes to file descriptor 1 directly ends up on stderr
+channel = os.fdopen(os.dup(1), 'w')
+os.dup2(2, 1)
+modules = {}
+
+def load(path):
+    mtime = os.path.getmtime(path)
+    if path in modules and modules[path][0] == mtime:
+        return modules[path][1]
+    name = 'nagios_plugin_{0}'.format(len(modules))
+    if spec_from_file_location is None:
+        module = imp.load_source(name, path)
+    else:
+        spec = spec_from_file_location(name, path)
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+    modules[path] = (mtime, module)
+    return module
+
+def run(path, entry_point):
+    # Same exit code as the interpreter would exit with
+    try:
+        if entry_point:
+            result = getattr(load(path), entry_point)()
+            return result if isinstance(result, int) and not isinstance(result, bool) else 0
+        runpy.run_path(path, run_name='__main__')
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        sys.stderr.write('{0}\n'.format(e.code))
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    sys.argv = [request['path']] + request['args']
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        returncode = run(request['path'], request['entry_point'])
+        sys.stdout.flush()
+        output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    channel.write(json.dumps({'output': output, 'stderr': errors, 'returncode': returncode}) + '\n')
+    channel.flush()
+"""
+
+def _popen_kwargs():
+    if os.name != 'posix':
+        return {}
+    # Own process group, so that the whole group can be killed on timeout
+    if PY3:
+        return {'start_new_session': True}
+    return {'preexec_fn': os.setsid}
+
+def _kill(process):
+    """Kill a process started with _popen_kwargs and any processes it started"""
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        pass
+
+class PythonPluginWorker(object):
+    """A Python process that runs plugins of the inprocess runner one at a time, and is kept across runs"""
+
+    def __init__(self, python_executable):
+        self.python_executable = python_executable
+        self.process = subprocess.Popen([python_executable, '-c', INPROCESS_WORKER],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, **_popen_kwargs())
+
+    def run(self, path, args, entry_point, timeout):
+        """Returns the output, the stderr and the exit code of the plugin, and whether it timed out. A worker that
+        timed out is killed."""
+        request = json.dumps({'path': path, 'args': args, 'entry_point': entry_point}) + '\n'
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            _kill(self.process)
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            self.process.stdin.write(request.encode('utf-8'))
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (IOError, OSError):
+            line = b''
+        finally:
+            timer.cancel()
+
+        if not line:
+            self.stop()
+            if timed_out.is_set():
+                return '', '', None, True
+            raise Exception("Python plugin worker exited with code {code}".format(code=self.process.returncode))
+        response = json.loads(line.decode('utf-8'))
+        return response['output'], response['stderr'], response['returncode'], False
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        _kill(self.process)
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
 class NagiosPluginWrapperCheck(AgentCheck):
-    PERFDATA_RE = (
-        r"([^\s]+|'[^']+')=([-.\d]+)(c|s|ms|us|B|KB|MB|GB|TB|%)?" +
-        r"(?:;([-.\d]+))?(?:;([-.\d]+))?(?:;([-.\d]+))?(?:;([-.\d]+))?")
+    SANITIZE_RE = re.compile(r"[^\w-]")
+    # Plugins report the same labels on every run, so metric names are only built once. The cache is bounded in case a
+    # plugin puts something like a timestamp in its labels.
+    METRIC_NAME_CACHE_SIZE = 10000
+    UOM_CHARS = '%' + string.ascii_letters
+    # Spans scanned by the perfdata tokenizer, matched from its current position
+    SPACES_RE = re.compile(r"\s*")
+    LABEL_RE = re.compile(r"[^=\s]*")
+    FIELDS_RE = re.compile(r"\S*")
+
+    # Nagios reports a plugin that exceeds service_check_timeout as CRITICAL by default
+    DEFAULT_TIMEOUT = 60
+    DEFAULT_MAX_WORKERS = 4
+    CACHED_PERFDATA_MODES = ('reemit', 'suppress')
+    RUNNERS = ('subprocess', 'inprocess')
+
+    def __init__(self, *args, **kwargs):
+        super(NagiosPluginWrapperCheck, self).__init__(*args, **kwargs)
+        # The executor and the state of each plugin outlive a run, so that plugins with their own
+        # min_collection_interval can keep running in the background across collections.
+        self._executor = None
+        self._command_states = {}
+        self._metric_names = {}
+        # Idle workers of the inprocess runner, by Python executable
+        self._idle_workers = {}
+        self._workers_lock = threading.Lock()
 
     def check(self, instance):
-        check_command = instance.get('check_command')
-        metric_namespace = instance.get('metric_namespace')
-        tags = instance.get('tags', [])
-        create_service_check = instance.get('create_service_check', False)
+        commands = self._get_commands(instance)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=min(instance.get('max_workers', self.DEFAULT_MAX_WORKERS), len(commands)))
 
-        if not check_command:
-            raise CheckException("Configuration error. Missing check_command definition, please fix nagios_plugin_wrapper.yaml")
+        # Start every plugin that is due. Plugins without their own min_collection_interval are due on every run and
+        # their results are submitted from this thread as each one finishes, so the check takes about as long as the
+        # slowest of them. The others are left running and their results are picked up by the first run after they
+        # finish.
+        now = time.time()
+        failed_commands = []
+        waiting = {}
+        for command in commands:
+            state = self._command_states.setdefault(self._command_key(command),
+                                                    {'future': None, 'last_run': None, 'result': None})
+            if state['future'] is None and (state['last_run'] is None or
+                                            now - state['last_run'] >= command['min_collection_interval']):
+                state['future'] = self._executor.submit(self._run_command, command)
+                state['last_run'] = now
+            if command['min_collection_interval']:
+                self._collect(command, state, failed_commands)
+            else:
+                waiting[state['future']] = command
+        for future in as_completed(waiting):
+            command = waiting[future]
+            self._collect(command, self._command_states[self._command_key(command)], failed_commands)
 
-        if not metric_namespace:
-            raise CheckException("Configuration error. Missing metric_namespace definition, please fix nagios_plugin_wrapper.yaml")
+        if failed_commands:
+            raise CheckException("check_command {check_commands} failed to execute, see agent.log for more information.".format(
+                check_commands=", ".join("'{0}'".format(c) for c in failed_commands)))
 
-        raw_output = None
-        err = None
-        ret = None
-        try:
-            raw_output, err, ret = get_subprocess_output(check_command, self.log)
-        except Exception as e:
-            error = "Failed to execute check_command {check_command} - {error}".format(
-                check_command=check_command, error=e)
-            self.log.warning(error)
-            raise CheckException("check_command '{check_command}' failed to execute, see agent.log for more information.".format(
-                check_command=check_command
-        ))
+    def _collect(self, command, state, failed_commands):
+        """Submits the result of the plugin if it finished, else its last result unless cached_perfdata is suppress"""
+        future = state['future']
+        if future is not None and future.done():
+            state['future'] = None
+            try:
+                state['result'] = self._parse_result(command, *future.result())
+            except Exception as e:
+                state['result'] = None
+                error = "Failed to execute check_command {check_command} - {error}".format(
+                    check_command=command['check_command'], error=e)
+                self.log.warning(error)
+                failed_commands.append(command['check_command'])
+                return
+        elif command['cached_perfdata'] == 'suppress':
+            return
+        # Between two runs of a plugin, its last result is submitted again
+        if state['result'] is not None:
+            self._submit(command, state['result'])
+
+    def cancel(self):
+        """Called by the agent when the check is unscheduled"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        with self._workers_lock:
+            workers = [worker for idle in self._idle_workers.values() for worker in idle]
+            self._idle_workers = {}
+        for worker in workers:
+            worker.stop()
+
+    def _get_commands(self, instance):
+        """Returns the commands of the instance, either the check_commands list or the single check_command.
+        Each command inherits the instance level settings it doesn't override."""
+        defaults = {
+            'metric_namespace': instance.get('metric_namespace'),
+            'tags': instance.get('tags', []),
+            'create_service_check': instance.get('create_service_check', False),
+            'timeout': instance.get('timeout', self.DEFAULT_TIMEOUT),
+            'cached_perfdata': instance.get('cached_perfdata', 'reemit'),
+            # The instance level min_collection_interval is the agent's, plugins only get their own
+            'min_collection_interval': 0,
+            'runner': instance.get('runner', 'subprocess'),
+            'python_executable': instance.get('python_executable', sys.executable),
+            'entry_point': instance.get('entry_point', 'main'),
+        }
+        if instance.get('check_commands'):
+            commands = []
+            for command_config in instance['check_commands']:
+                command = dict(defaults)
+                command.update(command_config)
+                command['tags'] = defaults['tags'] + command_config.get('tags', [])
+                commands.append(command)
+        else:
+            command = dict(defaults)
+            command['check_command'] = instance.get('check_command')
+            commands = [command]
 
+        for command in commands:
+            if not command.get('check_command'):
+                raise CheckException("Configuration error. Missing check_command definition, please fix nagios_plugin_wrapper.yaml")
+            if not command.get('metric_namespace'):
+                raise CheckException("Configuration error. Missing metric_namespace definition, please fix nagios_plugin_wrapper.yaml")
+            if command['cached_perfdata'] not in self.CACHED_PERFDATA_MODES:
+                raise CheckException("Configuration error. cached_perfdata must be one of {modes}, please fix nagios_plugin_wrapper.yaml".format(
+                    modes=", ".join(self.CACHED_PERFDATA_MODES)))
+            if command['runner'] not in self.RUNNERS:
+                raise CheckException("Configuration error. runner must be one of {runners}, please fix nagios_plugin_wrapper.yaml".format(
+                    runners=", ".join(self.RUNNERS)))
+        return commands
+
+    def _command_key(self, command):
+        return (str(command['check_command']), command['metric_namespace'])
+
+    def _run_command(self, command):
+        """Run a plugin, killing it (and any processes it started) if it runs for longer than its timeout.
+        Returns the output, the exit code and whether the plugin timed out."""
+        check_command = command['check_command']
+        # Same splitting as get_subprocess_output: no shell features
+        args = check_command.split() if isinstance(check_command, string_types) else list(check_command)
+        self.log.debug("Running check_command: {args}".format(args=args))
+
+        if command['runner'] == 'inprocess':
+            output, stderr, returncode, timed_out = self._run_inprocess(command, args)
+        else:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **_popen_kwargs())
+            timed_out = threading.Event()
+            def kill():
+                timed_out.set()
+                _kill(process)
+            timer = threading.Timer(command['timeout'], kill)
+            timer.start()
+            try:
+                stdout, stderr = process.communicate()
+            finally:
+                timer.cancel()
+            output, returncode, timed_out = stdout.decode('utf-8', 'replace'), process.returncode, timed_out.is_set()
+
+        if stderr:
+            self.log.debug("check_command {check_command} wrote to stderr: {stderr}".format(
+                check_command=check_command, stderr=stderr))
+        return output, returncode, timed_out
+
+    def _run_inprocess(self, command, args):
+        """Run a Python plugin in a worker process, so that the interpreter start-up and the imports of the plugin are
+        only paid once. A worker runs one plugin at a time, so there are as many as plugins running concurrently."""
+        python_executable = command['python_executable']
+        with self._workers_lock:
+            idle = self._idle_workers.get(python_executable)
+            worker = idle.pop() if idle else None
+        if worker is not None and not worker.alive():
+            worker.stop()
+            worker = None
+        if worker is None:
+            worker = PythonPluginWorker(python_executable)
+
+        result = worker.run(os.path.abspath(args[0]), args[1:], command['entry_point'], command['timeout'])
+        if worker.alive():
+            with self._workers_lock:
+                self._idle_workers.setdefault(python_executable, []).append(worker)
+        return result
+
+    def _parse_result(self, command, raw_output, ret, timed_out):
+        """Turn the output of a plugin into the metrics and service check to submit.
+        Returns a list of (metric name, value) and a (status, message) tuple or None."""
+        metric_namespace = command['metric_namespace']
+
+        if timed_out:
+            self.log.warning("check_command {check_command} timed out after {timeout} seconds and was killed".format(
+                check_command=command['check_command'], timeout=command['timeout']))
+            service_check = None
+            if command['create_service_check']:
+                service_check = (AgentCheck.CRITICAL, "Plugin timed out after {timeout} seconds".format(timeout=command['timeout']))
+            return [], service_check
+
+        gauges = []
         output, metrics = self._parse_output(raw_output)
         if metrics:
             metrics = self._parse_perfdata(metrics)
+            # Plugins can report hundreds of labels, don't format a message for each of them unless it's logged
+            debug = self.log.isEnabledFor(logging.DEBUG)
             for label, value in metrics:
-                label = self._sanitize(label)
-                self.log.debug("metric_namespace: {namespace} | tags: {tags} | value: {value} | ret_code: {ret}".format(
-                    namespace=metric_namespace, tags=tags, value=value, ret=ret))
-                self.gauge('{metric_namespace}.{label}'.format(
-                    metric_namespace=metric_namespace, label=label), value, tags=tags)
+                if debug:
+                    self.log.debug("metric_namespace: {namespace} | tags: {tags} | value: {value} | ret_code: {ret}".format(
+                        namespace=metric_namespace, tags=command['tags'], value=value, ret=ret))
+                gauges.append((self._metric_name(metric_namespace, label), value))
 
-        if output and create_service_check:
+        service_check = None
+        if output and command['create_service_check']:
             if ret == 0:
                 status = AgentCheck.OK
             elif ret == 1:
@@ -55,28 +369,54 @@ class NagiosPluginWrapperCheck(AgentCheck):
                 status = AgentCheck.CRITICAL
             else:
                 status = AgentCheck.UNKNOWN
-            self.service_check(metric_namespace, status, tags=tags, message=output.rstrip())
+            service_check = (status, output.rstrip())
+        return gauges, service_check
+
+    def _submit(self, command, result):
+        gauges, service_check = result
+        for metric, value in gauges:
+            self.gauge(metric, value, tags=command['tags'])
+        if service_check is not None:
+            status, message = service_check
+            self.service_check(command['metric_namespace'], status, tags=command['tags'], message=message)
 
     def _parse_output(self, s):
-        """Parse the output text and performance data string"""
-        try:
-            output, metrics = s.rsplit('|', 1)
-        except ValueError:
+        """Parse the output text and performance data string.
+        Performance data can follow a | on the first line, and on the long output lines from the first one with a |:
+
+            TEXT OUTPUT | PERFDATA
+            LONG TEXT LINE 1
+            LONG TEXT LINE 2 | PERFDATA LINE 2
+            PERFDATA LINE 3
+        """
+        lines = s.splitlines()
+        if not lines:
+            return s, None
+        text, separator, perfdata = lines[0].partition('|')
+        output_lines = [text.rstrip()]
+        perfdata_lines = [perfdata]
+        for number, line in enumerate(lines[1:], 1):
+            long_text, long_separator, perfdata = line.partition('|')
+            output_lines.append(long_text.rstrip())
+            if long_separator:
+                separator = long_separator
+                perfdata_lines.append(perfdata)
+                perfdata_lines.extend(lines[number + 1:])
+                break
+
+        if not separator:
             self.log.debug("No performance data found in string: {string}, skipping...".format(
                 string=s))
             return s, None
-        return output, metrics
+        return "\n".join(output_lines), " ".join(perfdata_lines)
 
     def _parse_perfdata(self, s):
         """Parse performance data from a perfdata string"""
         metrics = []
-        counters = re.findall(self.PERFDATA_RE, s)
-        if counters is None:
-            self.log.warning("Failed to parse performance data: {s}".format(
-                s=s))
-            return metrics
-
-        for (key, value, uom, warn, crit, min, max) in counters:
+        for (key, value, uom, warn, crit, min, max) in self._tokenize_perfdata(s):
+            if not value:
+                # 'U' means the plugin couldn't determine the value
+                continue
             try:
                 norm_value = self._normalize_to_unit(float(value), uom)
                 metrics.append((key, norm_value))
@@ -87,6 +427,52 @@ class NagiosPluginWrapperCheck(AgentCheck):
 
         return metrics
 
+    def _tokenize_perfdata(self, s):
+        """Split a perfdata string in a single pass into (label, value, uom, warn, crit, min, max) tuples,
+        for the format 'label'=value[UOM];[warn];[crit];[min];[max]. Labels can be quoted to contain spaces or =,
+        with '' standing for a quote, and warn and crit are ranges such as 10, 10:, ~:10, 10:20 or @10:20.
+        Missing fields are empty strings. Malformed items are logged and skipped."""
+        tokens = []
+        length = len(s)
+        position = self.SPACES_RE.match(s).end()
+        while position < length:
+            start = position
+            if s[position] == "'":
+                label = []
+                position += 1
+                while True:
+                    quote = s.find("'", position)
+                    if quote == -1:
+                        label.append(s[position:])
+                        position = length
+                    elif s[quote + 1:quote + 2] == "'":
+                        label.append(s[position:quote + 1])
+                        position = quote + 2
+                        continue
+                    else:
+                        label.append(s[position:quote])
+                        position = quote + 1
+                    break
+                label = "".join(label)
+            else:
+                position = self.LABEL_RE.match(s, position).end()
+                label = s[start:position]
+
+            if position >= length or s[position] != '=' or not label:
+                position = self.FIELDS_RE.match(s, position).end()
+                self.log.debug("Failed to parse performance data: {item}".format(item=s[start:position]))
+                position = self.SPACES_RE.match(s, position).end()
+                continue
+
+            end = self.FIELDS_RE.match(s, position + 1).end()
+            fields = s[position + 1:end].split(';', 4)
+            fields.extend([''] * (5 - len(fields)))
+            value, warn, crit, min, max = fields
+            number = value.rstrip(self.UOM_CHARS)
+            tokens.append((label, number, value[len(number):], warn, crit, min, max))
+            position = self.SPACES_RE.match(s, end).end()
+        return tokens
+
     def _normalize_to_unit(self, value, unit):
         """Normalize the value to the unit returned.
         We use base-1000 for second-based units, and base-1024 for
@@ -108,7 +494,19 @@ class NagiosPluginWrapperCheck(AgentCheck):
 
         return value
 
+    def _metric_name(self, metric_namespace, label):
+        key = (metric_namespace, label)
+        try:
+            return self._metric_names[key]
+        except KeyError:
+            pass
+        if len(self._metric_names) >= self.METRIC_NAME_CACHE_SIZE:
+            self._metric_names.clear()
+        name = self._metric_names[key] = '{metric_namespace}.{label}'.format(
+            metric_namespace=metric_namespace, label=self._sanitize(label))
+        return name
+
     def _sanitize(self, s):
         """Sanitize the name of a metric to remove unwanted chars
         """
-        return re.sub("[^\w-]", "", s)
+        return self.SANITIZE_RE.sub("", s)
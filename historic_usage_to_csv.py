@@ -7,68 +7,150 @@ If you choose to use to adapt them for use in a production environment, you do s
 
 import datetime
 import os
-import time
 import csv
 import requests
-import simplejson
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from multiprocessing.pool import ThreadPool
 
 """
 This script is meant to pull historical usage metrics and export them to CSV.  Set variables in __init__.
+
+The range is fetched in chunks of chunk_hours hours, several at a time, and the rows are written in hour order. When the
+CSV already exists, only the hours after its last one are fetched and appended, so a rerun, or a run picking up after
+a failed one, doesn't write any hour twice. A range starting before the first hour of the CSV is refused, as its hours
+couldn't be written in order: use another file for it.
 """
 
+HOUR_FORMAT = '%Y-%m-%dT%H'
+# Seconds to wait for the API to answer a chunk before giving up on it
+TIMEOUT = 60
+ONE_HOUR = datetime.timedelta(hours=1)
+
+COLUMNS = {
+    'hosts': ['hour', 'total_host_count', 'container_count', 'apm_host_count', 'agent_host_count', 'gcp_host_count', 'aws_host_count'],
+    'timeseries': ['hour', 'num_custom_timeseries'],
+    'logs': ['hour', 'indexed_events_count', 'ingested_events_bytes'],
+}
+FIELDS = {
+    'hosts': ['host_count', 'container_count', 'apm_host_count', 'agent_host_count', 'gcp_host_count', 'aws_host_count'],
+    'timeseries': ['num_custom_timeseries'],
+    'logs': ['indexed_events_count', 'ingested_events_bytes'],
+}
+
+def parse_hour(hour):
+    # The API gives hours as YYYY-MM-DDTHH, sometimes followed by minutes and a timezone
+    return datetime.datetime.strptime(hour[:13], HOUR_FORMAT)
+
+def format_hour(hour):
+    return hour.strftime(HOUR_FORMAT)
+
 class UsageReport(object):
 
-    def __init__(self, api_key, app_key, start_hour, end_hour, type, filename):
+    def __init__(self, api_key, app_key, start_hour, end_hour, type, filename, chunk_hours=168, workers=4):
         self.api_key = api_key
         self.app_key= app_key
+        self.start_hour = parse_hour(start_hour)
+        self.end_hour = parse_hour(end_hour)
         self.type = type
         self.filename = filename
-        self.url = 'https://app.datadoghq.com/api/v1/usage/' + type + '?api_key=' + api_key + '&application_key=' + app_key + '&start_hr=' + start_hour + '&end_hr=' + end_hour
+        self.chunk_hours = chunk_hours
+        self.workers = workers
+        self.url = 'https://app.datadoghq.com/api/v1/usage/' + type
+        self.session = requests.Session()
 
-    def get_usage_metrics(self):
-        usage_metrics = []
-        error_messages = []
+    def get_usage_metrics(self, start_hour, end_hour):
+        """Returns the usage of the hours from start_hour to end_hour (excluded), or None if they couldn't be retrieved"""
+        params = {'api_key': self.api_key, 'application_key': self.app_key,
+                  'start_hr': format_hour(start_hour), 'end_hr': format_hour(end_hour)}
         try:
-            metrics = requests.get(self.url).json()
+            metrics = self.session.get(self.url, params=params, timeout=TIMEOUT).json()
             if metrics.get('errors', None):
-                print(metrics['errors'])
-                return usage_metrics
-            usage_metrics = metrics.get('usage', None)
-            error_messages = metrics.get('errors', [])
-            for m in error_messages:
-                print('Error when retrieving metrics: {}'.format(m))
+                for m in metrics['errors']:
+                    print('Error when retrieving metrics from {} to {}: {}'.format(params['start_hr'], params['end_hr'], m))
+                return None
+            return metrics.get('usage', None) or []
         except requests.exceptions.MissingSchema:
-            print('Invalid URL format: {}'.format(url))
+            print('Invalid URL format: {}'.format(self.url))
         except requests.exceptions.ConnectionError:
-            print('Could not connect to url: {}'.format(url))
-        except simplejson.scanner.JSONDecodeError:
+            print('Could not connect to url: {}'.format(self.url))
+        except ValueError:
             print('The response did not contain JSON data')
-        return usage_metrics
+        except requests.exceptions.RequestException as e:
+            print('Error when retrieving metrics from {} to {}: {}'.format(params['start_hr'], params['end_hr'], e))
+        return None
+
+    def get_chunks(self, start_hour):
+        chunks = []
+        chunk = datetime.timedelta(hours=self.chunk_hours)
+        while start_hour < self.end_hour:
+            chunks.append((start_hour, min(start_hour + chunk, self.end_hour)))
+            start_hour += chunk
+        return chunks
+
+    def get_hours(self):
+        """Returns the first and the last hours written to the CSV, or None, None if there are none"""
+        first_hour = last_hour = None
+        if not os.path.isfile(self.filename):
+            return first_hour, last_hour
+        with open(self.filename) as input_file:
+            for row in csv.reader(input_file):
+                try:
+                    hour = parse_hour(row[0])
+                except (IndexError, ValueError):
+                    continue
+                if first_hour is None or hour < first_hour:
+                    first_hour = hour
+                if last_hour is None or hour > last_hour:
+                    last_hour = hour
+        return first_hour, last_hour
 
     def gen_usage_report(self):
-        # Get usage metrics from Datadog
-        metrics = self.get_usage_metrics()
-        # print(metrics)
-        file_exists = os.path.isfile(self.filename)
-        with open(self.filename, mode='a+') as output_file:
-            metric_writer = csv.writer(output_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            if not file_exists:
-                if self.type == 'hosts':
-                    metric_writer.writerow(['hour', 'total_host_count', 'container_count', 'apm_host_count', 'agent_host_count', 'gcp_host_count', 'aws_host_count'])
-                elif self.type == 'timeseries':
-                    metric_writer.writerow(['hour', 'num_custom_timeseries'])
-                elif self.type == 'logs':
-                    metric_writer.writerow(['hour', 'indexed_events_count', 'ingested_events_bytes'])
+        # Only the hours after the last one already in the CSV are fetched
+        first_hour, last_hour = self.get_hours()
+        if first_hour is not None and self.start_hour < first_hour:
+            print('{} starts at {}, the hours before it can\'t be added to it, use another file for them'.format(self.filename, format_hour(first_hour)))
+            exit(1)
+        start_hour = self.start_hour
+        if last_hour is not None and last_hour + ONE_HOUR > start_hour:
+            start_hour = last_hour + ONE_HOUR
+            print('{} already has the hours up to {}, fetching from {}'.format(self.filename, format_hour(last_hour), format_hour(start_hour)))
+        chunks = self.get_chunks(start_hour)
+        if not chunks:
+            print('Nothing to fetch')
+            return
+
+        # Get usage metrics from Datadog, several chunks at a time
+        pool = ThreadPool(max(1, min(self.workers, len(chunks))))
+        try:
+            results = pool.map(lambda chunk: self.get_usage_metrics(*chunk), chunks)
+        finally:
+            pool.close()
+
+        # The rows are written in hour order up to the first chunk that failed, so that a rerun picks up from there
+        rows = {}
+        failed_chunk = None
+        for chunk, metrics in zip(chunks, results):
+            if metrics is None:
+                failed_chunk = chunk
+                break
             for m in metrics:
-                hour = m.get('hour', False)
-                if self.type == 'hosts':
-                    metric_writer.writerow([hour, m['host_count'], m['container_count'], m['apm_host_count'], m['agent_host_count'], m['gcp_host_count'], m['aws_host_count']])
-                elif self.type == 'timeseries':
-                    metric_writer.writerow([hour, m['num_custom_timeseries']])
-                elif self.type == 'logs':
-                    metric_writer.writerow([hour, m['indexed_events_count'], m['ingested_events_bytes']])
+                hour = parse_hour(m['hour'])
+                if chunk[0] <= hour < chunk[1]:
+                    rows[hour] = [m['hour']] + [m[field] for field in FIELDS[self.type]]
+
+        write_header = not os.path.isfile(self.filename) or os.path.getsize(self.filename) == 0
+        with open(self.filename, mode='a') as output_file:
+            metric_writer = csv.writer(output_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            if write_header:
+                metric_writer.writerow(COLUMNS[self.type])
+            for hour in sorted(rows):
+                metric_writer.writerow(rows[hour])
+        print('Wrote {} hours to {}'.format(len(rows), self.filename))
+
+        if failed_chunk is not None:
+            print('Could not retrieve the usage from {}, rerun to fetch the rest'.format(format_hour(failed_chunk[0])))
+            exit(1)
 
 
 if __name__ == '__main__':
@@ -79,6 +161,8 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--end_hour', help='YYYY-MM-DDTHH (ex. 2018-12-01T01)', required=True)
     parser.add_argument('-t', '--type', help='One of "hosts", "logs", or "timeseries" (metrics)', required=True)
     parser.add_argument('-f', '--filename',help='Filename to export metrics', required=True)
+    parser.add_argument('-c', '--chunk_hours', type=int, default=168, help='Hours fetched per request (default: 168)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Requests made at the same time (default: 4)')
 
 
     args = parser.parse_args()
@@ -94,4 +178,15 @@ if __name__ == '__main__':
         exit(0)
     print(args)
 
-    UsageReport(api_key, app_key, start_hour, end_hour, type, filename).gen_usage_report()
+    try:
+        import rate_limit_telemetry
+        rate_limit_telemetry.install(api_key, tags=['script:historic_usage_to_csv'])
+    except ImportError:
+        pass
+    try:
+        import api_throttle
+        api_throttle.install()
+    except ImportError:
+        pass
+
+    UsageReport(api_key, app_key, start_hour, end_hour, type, filename, args.chunk_hours, args.workers).gen_usage_report()
@@ -1,4 +1,6 @@
 from datadog import initialize, api
+import os
+import sys
 from os import environ
 from sys import argv
 
@@ -11,6 +13,14 @@ OPTIONS = {
 # Initialize the Datadog API client.
 initialize(**OPTIONS)
 
+# Shares the API rate limits with the other scripts of the host, with api_throttle.py from the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    import api_throttle
+    api_throttle.install()
+except ImportError:
+    sys.stderr.write("api_throttle.py not found, the API rate limits are not shared with the other scripts\n")
+
 # These are the types of widgets that would be updated.
 # See https://docs.datadoghq.com/dashboards/widgets
 SUPPORTED_WIDGETS = ['timeseries', 'query_value', 'toplist', 'change']
@@ -17,6 +17,17 @@ options = {
 
 initialize(**options)
 
+try:
+    import rate_limit_telemetry
+    rate_limit_telemetry.install(DD_API_KEY, tags=['script:query_hosts_create_tags'])
+except ImportError:
+    pass
+try:
+    import api_throttle
+    api_throttle.install()
+except ImportError:
+    pass
+
 initial_filter_string = '' # string to query datadog api for matching hosts.  this may return more hosts than you are looking for.
 
 query_key = 'host_name' # any key of the host object (i.e. 'platform', 'id') to use when iterating over the search results.  host_name is default.
@@ -0,0 +1,184 @@
+"""
+Passive Datadog API rate limit telemetry.
+
+Every response of the Datadog API carries the rate limit of its endpoint in X-RateLimit-* headers. This module records
+them from the responses a script already gets and sends them, every flush interval and when the script exits, as the
+same metrics api_limits_as_custom_metrics.py sends (X-RateLimit-Limit, X-RateLimit-Period, X-RateLimit-Remaining and
+X-RateLimit-Reset, tagged with the endpoint), so that watching the rate limits doesn't spend the limits being watched.
+X-RateLimit-Remaining is the lowest value seen over the flush interval.
+
+Scripts use it when it is there, and run as before when it isn't:
+
+    try:
+        import rate_limit_telemetry
+        rate_limit_telemetry.install(api_key, tags=['script:my_script'])
+    except ImportError:
+        pass
+
+install() records the responses of every requests session of the process, including the ones the datadog library
+makes. instrument(session, tags) records the responses of one session only, with tags of its own, e.g. to tell apart
+the orgs of a script talking to several orgs.
+"""
+
+import atexit
+import re
+import sys
+import threading
+import time
+
+import requests
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+DEFAULT_API_HOST = 'https://api.datadoghq.com'
+FLUSH_INTERVAL = 60
+
+RATE_LIMIT_HEADERS = [
+    'X-RateLimit-Limit',
+    'X-RateLimit-Period',
+    'X-RateLimit-Remaining',
+    'X-RateLimit-Reset',
+]
+
+API_PREFIX_RE = re.compile(r'^/api/v\d+/')
+# Endpoints whose next path segment is a name or an id rather than part of the endpoint, e.g. the hostname in
+# tags/hosts/<hostname>, with the segments that can follow them and aren't one
+ID_POSITIONS = {
+    'dashboard': ('lists',),
+    'dashboard/lists/manual': (),
+    'downtime': ('cancel',),
+    'logs/config/pipelines': (),
+    'monitor': ('can_delete', 'groups', 'search', 'validate'),
+    'notebooks': (),
+    'slo': ('bulk_delete', 'can_delete', 'search'),
+    'synthetics/tests': ('api', 'browser', 'delete', 'search', 'trigger'),
+    'synthetics/tests/api': (),
+    'synthetics/tests/browser': (),
+    'tags/hosts': (),
+    'user': (),
+    'users': (),
+}
+# Elsewhere, path segments that look like names or ids, e.g. numbers, hostnames and emails
+VARIABLE_SEGMENT_RE = re.compile(r'[\d.:@%]')
+
+def endpoint_of(url):
+    path = API_PREFIX_RE.sub('', urlparse(url).path).strip('/')
+    endpoint = []
+    for segment in path.split('/'):
+        not_ids = ID_POSITIONS.get('/'.join(endpoint))
+        if (not_ids is not None and segment not in not_ids) or VARIABLE_SEGMENT_RE.search(segment):
+            segment = '{id}'
+        endpoint.append(segment)
+    return '/'.join(endpoint)
+
+class RateLimitRecorder(object):
+    """ Keeps the last rate limit seen for each endpoint and set of tags since the last collect. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {} # (endpoint, tags) -> header -> value
+
+    def record(self, response, tags=()):
+        headers = response.headers
+        if 'X-RateLimit-Limit' not in headers:
+            return
+        try:
+            values = dict((header, int(headers[header])) for header in RATE_LIMIT_HEADERS if header in headers)
+        except ValueError:
+            return
+        key = (endpoint_of(response.url), tuple(tags))
+        with self.lock:
+            limits = self.endpoints.setdefault(key, {})
+            if 'X-RateLimit-Remaining' in values and 'X-RateLimit-Remaining' in limits:
+                values['X-RateLimit-Remaining'] = min(values['X-RateLimit-Remaining'], limits['X-RateLimit-Remaining'])
+            limits.update(values)
+
+    def hook(self, tags=()):
+        # A requests response hook recording with the given tags
+        tags = tuple(tags)
+
+        def record_response(response, *args, **kwargs):
+            self.record(response, tags)
+        return record_response
+
+    def collect(self, tags=()):
+        # Returns the series of what was recorded since the last collect
+        now = int(time.time())
+        with self.lock:
+            endpoints, self.endpoints = self.endpoints, {}
+        series = []
+        for (endpoint, endpoint_tags), limits in sorted(endpoints.items()):
+            for header in RATE_LIMIT_HEADERS:
+                if header in limits:
+                    series.append({
+                        'metric': header,
+                        'points': [[now, limits[header]]],
+                        'tags': ["endpoint:%s" % endpoint] + list(endpoint_tags) + list(tags)
+                    })
+        return series
+
+recorder = RateLimitRecorder()
+
+_lock = threading.Lock()
+_global_hook = None
+_flusher = None
+
+def install(api_key=None, tags=None, api_host=DEFAULT_API_HOST, flush_interval=FLUSH_INTERVAL):
+    """ Records the responses of every requests session created from now on, and sends them with api_key if given. """
+    global _global_hook
+    with _lock:
+        if _global_hook is None:
+            _global_hook = recorder.hook()
+            original_init = requests.Session.__init__
+
+            def __init__(self, *args, **kwargs):
+                original_init(self, *args, **kwargs)
+                self.hooks['response'].append(_global_hook)
+            requests.Session.__init__ = __init__
+    if api_key:
+        start_flushing(api_key, tags, api_host, flush_interval)
+
+def instrument(session, tags=None):
+    """ Records the responses of session with tags, instead of with the tags of install() if it was called. """
+    hooks = session.hooks['response']
+    if _global_hook in hooks:
+        hooks.remove(_global_hook)
+    hooks.append(recorder.hook(tags or []))
+    return session
+
+def start_flushing(api_key, tags=None, api_host=DEFAULT_API_HOST, flush_interval=FLUSH_INTERVAL):
+    """ Sends what was recorded every flush_interval seconds, and at exit. Only the first call starts flushing. """
+    global _flusher
+    with _lock:
+        if _flusher is not None:
+            return
+        _flusher = Flusher(api_key, tags or [], api_host, flush_interval)
+    _flusher.start()
+    atexit.register(_flusher.flush)
+
+class Flusher(threading.Thread):
+    def __init__(self, api_key, tags, api_host, flush_interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = api_host.rstrip('/') + '/api/v1/series'
+        self.api_key = api_key
+        self.tags = tags
+        self.flush_interval = flush_interval
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        series = recorder.collect(self.tags)
+        if not series:
+            return
+        try:
+            requests.post(self.url, json={'series': series}, headers={'DD-API-KEY': self.api_key},
+                          timeout=10).raise_for_status()
+        except requests.RequestException as e:
+            sys.stderr.write("failed to send the API rate limits: %s\n" % e)
@@ -34,6 +34,12 @@ def remove_host_tags_by_source(hostname, source, session):
 
 
 # main
+try:
+    import api_throttle
+    api_throttle.install()
+except ImportError:
+    pass
+
 s = requests.session()
 
 s.params = {
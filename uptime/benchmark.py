@@ -0,0 +1,286 @@
+"""
+Benchmark for the uptime check.
+
+Generates a synthetic uptime history, then runs UptimeCheck.check against it under a stub AgentCheck and reports the
+latency of each run, the bytes read and mapped, and the number of fsyncs. The history is generated as a text uptime
+log, which is the one format every version of the check can be given, and is migrated with migrate_uptime_log.py when
+the check asks for it. To compare a change before and after on the same data, run the benchmark with the same seed
+against both versions of uptime.py:
+
+    git show HEAD~1:uptime/uptime.py > /tmp/uptime_before.py
+    python benchmark.py --seed 1 --years 1 --check /tmp/uptime_before.py
+    python benchmark.py --seed 1 --years 1
+
+The agent doesn't need to be installed. Bytes read are taken from /proc/self/io, so they are only reported on Linux.
+"""
+
+import json
+import math
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import types
+
+from argparse import ArgumentParser
+
+import migrate_uptime_log
+
+ONE_DAY = 86400
+ONE_YEAR = 31557600
+
+class CheckException(Exception):
+    pass
+
+class AgentCheck(object):
+    """ Just enough of the Agent 5 AgentCheck to run the uptime check. """
+    OK, WARNING, CRITICAL, UNKNOWN = range(4)
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        self.name = name
+        self.init_config = init_config
+        self.agentConfig = agentConfig
+        self.instances = instances or []
+        self.log = _NullLog()
+        self.gauges = {}
+
+    def gauge(self, metric, value, tags=None, hostname=None, device_name=None, timestamp=None):
+        self.gauges[metric] = value
+
+    def run(self):
+        for instance in self.instances:
+            self.check(instance)
+
+class _NullLog(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class FakeClock(object):
+    """ Stands in for the time module inside the check, so that runs happen at simulated times. """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(__import__('time'), name)
+
+class IOCounters(object):
+    """ Counts fsyncs and mapped bytes by wrapping os.fsync and mmap.mmap, and reads /proc/self/io for bytes read. """
+    def __init__(self, check_module):
+        self.fsyncs = 0
+        self.mapped_bytes = 0
+        real_fsync = os.fsync
+
+        def fsync(fd):
+            self.fsyncs += 1
+            return real_fsync(fd)
+        os.fsync = fsync
+
+        real_mmap = getattr(check_module, 'mmap', None)
+        if real_mmap is not None:
+            def counting_mmap(fileno, length, *args, **kwargs):
+                self.mapped_bytes += length
+                return real_mmap.mmap(fileno, length, *args, **kwargs)
+            shim = types.ModuleType('mmap')
+            shim.__dict__.update(real_mmap.__dict__)
+            shim.mmap = counting_mmap
+            check_module.mmap = shim
+
+    def snapshot(self):
+        return {'fsyncs': self.fsyncs, 'mapped_bytes': self.mapped_bytes, 'read_bytes': _read_chars()}
+
+def _read_chars():
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+def generate_history(rng, now, years, flaps_per_day, mean_downtime, downtime_threshold):
+    """ Returns the uptime intervals of a history ending at now, and the current interval.
+
+    Downtimes start at exponentially distributed times, flaps_per_day per day on average, and last an exponentially
+    distributed time of mean_downtime seconds on average, always longer than downtime_threshold so that each one ends
+    an interval. When the last downtime lasts past now, the host is down at now and the current interval is over.
+    """
+    intervals = []
+    start = now - int(years * ONE_YEAR)
+    while True:
+        up_for = int(rng.expovariate(flaps_per_day / float(ONE_DAY))) + 1 if flaps_per_day else now
+        end = start + up_for
+        if end >= now:
+            return intervals, (start, now)
+        next_start = end + downtime_threshold + 1 + int(rng.expovariate(1.0 / mean_downtime))
+        if next_start >= now:
+            # Down at now: the last uptime is the current interval, already over.
+            return intervals, (start, end)
+        intervals.append((start, end))
+        start = next_start
+
+def write_history(uptime_log_directory, intervals, current_interval):
+    with open(os.path.join(uptime_log_directory, 'uptime.log'), 'w') as uptime_log:
+        for start, end in intervals:
+            uptime_log.write("{0} {1}\n".format(start, end))
+    with open(os.path.join(uptime_log_directory, 'uptime'), 'w') as uptime_file:
+        uptime_file.write("{0} {1}\n".format(*current_interval))
+
+def load_check_module(path):
+    """ Loads uptime.py with the stub checks module in place of the agent's. """
+    checks = types.ModuleType('checks')
+    checks.AgentCheck = AgentCheck
+    checks.CheckException = CheckException
+    sys.modules['checks'] = checks
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source('uptime_under_benchmark', path)
+    spec = spec_from_file_location('uptime_under_benchmark', path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    now = 1500000000
+    intervals, current_interval = generate_history(rng, now, args.years, args.flaps_per_day, args.mean_downtime,
+                                                   args.downtime_threshold)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='uptime-benchmark-')
+    check_module = load_check_module(args.check)
+    clock = FakeClock(now)
+    check_module.time = clock
+
+    instances = []
+    for number in range(args.instances):
+        uptime_log_directory = os.path.join(workdir, 'instance-{0}'.format(number))
+        os.makedirs(uptime_log_directory)
+        write_history(uptime_log_directory, intervals, current_interval)
+        instances.append({
+            'uptime_log_directory': uptime_log_directory,
+            'downtime_threshold': args.downtime_threshold,
+            'retention': args.retention,
+            'metrics': [{'name': 'uptime.{0}'.format(timespan), 'timespan': timespan} for timespan in args.metrics],
+        })
+    init_config = {}
+    if args.group_commit:
+        init_config['group_commit_journal'] = os.path.join(workdir, 'uptime.journal')
+
+    check = check_module.UptimeCheck('uptime', init_config, {}, instances)
+    counters = IOCounters(check_module)
+
+    latencies = []
+    per_run = []
+    try:
+        for run in range(args.runs + 1):
+            clock.now += args.interval
+            # Flap during the benchmark at the same rate as in the history.
+            if args.flaps_per_day and rng.random() < args.flaps_per_day * args.interval / float(ONE_DAY):
+                clock.now += args.downtime_threshold + 1
+            before = counters.snapshot()
+            started = timeit.default_timer()
+            try:
+                check.run()
+            except CheckException as e:
+                if 'migrate_uptime_log' not in str(e):
+                    raise
+                for instance in instances:
+                    migrate_uptime_log.write_segments(intervals, instance['uptime_log_directory'], args.segment_span)
+                started = timeit.default_timer()
+                check.run()
+            elapsed = timeit.default_timer() - started
+            after = counters.snapshot()
+            # Let background work started by the first run finish so it isn't measured by a later run.
+            for compaction in getattr(check, 'instance_compactions', {}).values():
+                compaction.join()
+            if run == 0:
+                # The first run migrates, builds indexes and compacts, so it is reported separately.
+                first_run = elapsed
+                continue
+            latencies.append(elapsed)
+            per_run.append(dict((key, (after[key] - before[key]) if after[key] is not None else None)
+                                for key in after))
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir)
+
+    def total(key):
+        values = [run[key] for run in per_run]
+        return None if None in values else sum(values)
+
+    return {
+        'check': os.path.abspath(args.check),
+        'seed': args.seed,
+        'years': args.years,
+        'flaps_per_day': args.flaps_per_day,
+        'history_intervals': len(intervals),
+        'instances': args.instances,
+        'metrics': args.metrics,
+        'runs': args.runs,
+        'first_run_ms': first_run * 1000,
+        'latency_ms': {
+            'min': min(latencies) * 1000,
+            'median': percentile(latencies, 0.5) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'max': max(latencies) * 1000,
+        },
+        'read_bytes_per_run': total('read_bytes') and float(total('read_bytes')) / args.runs,
+        'mapped_bytes_per_run': float(total('mapped_bytes')) / args.runs,
+        'fsyncs_per_run': float(total('fsyncs')) / args.runs,
+    }
+
+def print_report(report):
+    print("check:              {0}".format(report['check']))
+    print("history:            {0} intervals over {1} years ({2} flaps/day), seed {3}".format(
+        report['history_intervals'], report['years'], report['flaps_per_day'], report['seed']))
+    print("instances:          {0}, metrics: {1}".format(report['instances'], report['metrics']))
+    print("first run:          {0:.3f} ms".format(report['first_run_ms']))
+    print("latency over {0} runs: min {min:.3f} ms, median {median:.3f} ms, p95 {p95:.3f} ms, max {max:.3f} ms".format(
+        report['runs'], **report['latency_ms']))
+    read_bytes = report['read_bytes_per_run']
+    print("bytes read/run:     {0}".format('n/a' if read_bytes is None else '{0:.0f}'.format(read_bytes)))
+    print("bytes mapped/run:   {0:.0f}".format(report['mapped_bytes_per_run']))
+    print("fsyncs/run:         {0:.2f}".format(report['fsyncs_per_run']))
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = ArgumentParser(description='Benchmark the uptime check against a synthetic uptime history.')
+    parser.add_argument('--check', default=os.path.join(here, 'uptime.py'),
+                        help='Path to the uptime.py to benchmark (default: the one next to this script)')
+    parser.add_argument('--years', type=float, default=1, help='Length of the generated history in years')
+    parser.add_argument('--flaps-per-day', type=float, default=5, help='Average number of downtimes per day')
+    parser.add_argument('--mean-downtime', type=float, default=300, help='Average length of a downtime in seconds')
+    parser.add_argument('--metrics', type=lambda value: [int(timespan) for timespan in value.split(',')],
+                        default=[3600, ONE_DAY, 7 * ONE_DAY, 30 * ONE_DAY, 365 * ONE_DAY],
+                        help='Comma separated metric timespans in seconds')
+    parser.add_argument('--runs', type=int, default=200, help='Number of measured check runs')
+    parser.add_argument('--interval', type=int, default=15, help='Simulated seconds between check runs')
+    parser.add_argument('--instances', type=int, default=1, help='Number of instances, each with a copy of the history')
+    parser.add_argument('--downtime-threshold', type=int, default=60)
+    parser.add_argument('--retention', type=int, default=ONE_YEAR)
+    parser.add_argument('--segment-span', type=int, default=2592000,
+                        help='Segment span used when migrating the generated history')
+    parser.add_argument('--group-commit', action='store_true', help='Enable group commit mode')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the history generator')
+    parser.add_argument('--workdir', help='Directory to generate the histories in (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help="Don't delete the temporary directory")
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
@@ -0,0 +1,90 @@
+"""
+Converts an uptime log written by older versions of the uptime check, either the text log (uptime.log) or the single
+binary log (uptime.bin), to the segmented binary log (uptime-<bucket>.bin) that the check now reads.
+
+Stop the agent before running this script. The old log is left in place so that it can be kept as a backup. The
+segment indexes are built by the check the next time it runs.
+
+Usage: python migrate_uptime_log.py <uptime_log_directory> [--segment-span SECONDS]
+"""
+
+import os
+import os.path
+import struct
+import sys
+
+from argparse import ArgumentParser
+
+# Must match the record format and segment file names in uptime.py
+RECORD = struct.Struct('<qq')
+SEGMENT_FILENAME = 'uptime-{0}.bin'
+
+def read_text_intervals(text_uptime_log_path):
+    intervals = []
+    with open(text_uptime_log_path) as text_uptime_log:
+        for line_number, line in enumerate(text_uptime_log, 1):
+            if not line.strip():
+                continue
+            try:
+                start, end = [int(value) for value in line.split()]
+            except ValueError:
+                raise ValueError("Line {0} is not a valid interval: {1!r}".format(line_number, line))
+            intervals.append((start, end))
+    return intervals
+
+def read_binary_intervals(binary_uptime_log_path):
+    with open(binary_uptime_log_path, 'rb') as binary_uptime_log:
+        data = binary_uptime_log.read()
+    # A partially written record at the end of the log is ignored, as the check does.
+    return [RECORD.unpack_from(data, offset) for offset in range(0, len(data) // RECORD.size * RECORD.size, RECORD.size)]
+
+def validate_intervals(intervals):
+    for number, (start, end) in enumerate(intervals, 1):
+        if start > end:
+            raise ValueError("Interval {0}: start ({1}) is greater than end ({2})".format(number, start, end))
+        if number > 1 and start < intervals[number - 2][1]:
+            raise ValueError("Interval {0} overlaps or precedes the previous one".format(number))
+
+def write_segments(intervals, uptime_log_directory, segment_span):
+    segments = {}
+    for start, end in intervals:
+        segments.setdefault(start - start % segment_span, []).append((start, end))
+    for bucket, segment_intervals in sorted(segments.items()):
+        segment_path = os.path.join(uptime_log_directory, SEGMENT_FILENAME.format(bucket))
+        tmp_segment_path = segment_path + ".tmp"
+        with open(tmp_segment_path, 'wb') as tmp_segment:
+            for start, end in segment_intervals:
+                tmp_segment.write(RECORD.pack(start, end))
+            tmp_segment.flush()
+            os.fsync(tmp_segment)
+        # The segments don't exist yet, so a plain rename is enough on every platform.
+        os.rename(tmp_segment_path, segment_path)
+    return len(segments)
+
+def migrate(uptime_log_directory, segment_span):
+    if any(filename.startswith('uptime-') and filename.endswith('.bin')
+           for filename in os.listdir(uptime_log_directory)):
+        sys.exit("{0} already contains uptime log segments, refusing to overwrite them".format(uptime_log_directory))
+
+    binary_uptime_log_path = os.path.join(uptime_log_directory, 'uptime.bin')
+    text_uptime_log_path = os.path.join(uptime_log_directory, 'uptime.log')
+    if os.path.isfile(binary_uptime_log_path):
+        source_path = binary_uptime_log_path
+        intervals = read_binary_intervals(binary_uptime_log_path)
+    elif os.path.isfile(text_uptime_log_path):
+        source_path = text_uptime_log_path
+        intervals = read_text_intervals(text_uptime_log_path)
+    else:
+        sys.exit("No uptime log found in {0}".format(uptime_log_directory))
+
+    validate_intervals(intervals)
+    segment_count = write_segments(intervals, uptime_log_directory, segment_span)
+    print("Migrated {0} intervals from {1} to {2} segments".format(len(intervals), source_path, segment_count))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Convert an old uptime log to the segmented format used by the uptime check.')
+    parser.add_argument('uptime_log_directory', help='The uptime_log_directory of the check instance')
+    parser.add_argument('--segment-span', type=int, default=2592000,
+                        help='The segment_span of the check instance, in seconds (default: 2592000, 30 days)')
+    args = parser.parse_args()
+    migrate(args.uptime_log_directory, args.segment_span)
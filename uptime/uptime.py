@@ -1,12 +1,37 @@
+import bisect
+import json
+import mmap
 import os
 import os.path
+import re
+import socket
+import struct
 import sys
+import threading
 import time
 
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+# psutil ships with the agent, but is only needed by the process probe.
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 from checks import AgentCheck, CheckException
 
 # Modify this function to allow custom logic for determining whether the host is up. Note that this check is run in
-# the main collector thread, so slow tasks performed in this function may reduce the agent's reporting frequency.
+# the main collector thread, so slow tasks performed in this function may reduce the agent's reporting frequency. Slow
+# conditions should be configured as probes instead, which run in background threads.
 def is_up():
     return True
 
@@ -20,6 +45,16 @@ if sys.platform == 'win32':
 else:
     replace = os.rename
 
+# The uptime log is split into segments, each holding the entries that started in one time bucket of segment_span
+# seconds, so that old entries are expired by deleting whole segments. Each entry of a segment is a fixed-width record
+# of two little-endian signed 64 bit integers: the start and the end of the interval. This must match the format written
+# by migrate_uptime_log.py.
+SEGMENT_RE = re.compile(r'^uptime-(\d+)\.bin$')
+RECORD = struct.Struct('<qq')
+# Each segment has an index that holds one little-endian signed 64 bit integer per entry of the segment: the total
+# length of every entry before it. The uptime of any range of entries is then the difference of two index values.
+PREFIX_SUM = struct.Struct('<q')
+
 class UptimeMetricAggregator:
     def __init__(self, name, start, end):
         self.name = name
@@ -32,17 +67,357 @@ class UptimeInterval:
         self.start = start
         self.end = end
 
+class UptimeLog:
+    """ Read-only, memory mapped view of the uptime log and its index.
+
+    Entries are sorted and don't overlap, so both their starts and their ends are in increasing order, which lets us
+    binary search for the entries inside a time window. A partially written record at the end of the log is ignored.
+    The index must have been brought up to date with sync_uptime_index.
+    """
+    def __init__(self, uptime_log_path, uptime_index_path):
+        self._count = 0
+        self._map = _map_file(uptime_log_path, RECORD.size)
+        self._index_map = _map_file(uptime_index_path, PREFIX_SUM.size)
+        if self._map is not None and self._index_map is not None:
+            self._count = min(len(self._map) // RECORD.size, len(self._index_map) // PREFIX_SUM.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for mapped in (self._map, self._index_map):
+            if mapped is not None:
+                mapped.close()
+        self._map = self._index_map = None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        return UptimeInterval(*RECORD.unpack_from(self._map, index * RECORD.size))
+
+    def start(self, index):
+        return RECORD.unpack_from(self._map, index * RECORD.size)[0]
+
+    def end(self, index):
+        return RECORD.unpack_from(self._map, index * RECORD.size)[1]
+
+    def prefix_sum(self, index):
+        """ Returns the total length of the entries before index, offset by the length of any stripped entries. """
+        if index < self._count:
+            return PREFIX_SUM.unpack_from(self._index_map, index * PREFIX_SUM.size)[0]
+        last = self[self._count - 1]
+        return self.prefix_sum(self._count - 1) + last.end - last.start
+
+    def first_ending_after(self, ts):
+        """ Returns the index of the first entry that ends after ts, or len(self) if there is none. """
+        return bisect.bisect_right(_UptimeLogColumn(self, self.end), ts)
+
+    def first_starting_at_or_after(self, ts):
+        """ Returns the index of the first entry that starts at or after ts, or len(self) if there is none. """
+        return bisect.bisect_left(_UptimeLogColumn(self, self.start), ts)
+
+    def uptime_in_window(self, start, end):
+        """ Returns the uptime recorded in the log between start and end. """
+        first = self.first_ending_after(start)
+        last = self.first_starting_at_or_after(end)
+        if first >= last:
+            return 0
+        uptime = self.prefix_sum(last) - self.prefix_sum(first)
+        # Only the parts of the first and last entries that are inside the window count.
+        uptime -= max(0, start - self.start(first))
+        uptime -= max(0, self.end(last - 1) - end)
+        return uptime
+
+class SegmentedUptimeLog:
+    """ Read-only view of every segment of the uptime log. """
+    def __init__(self, segments):
+        self._logs = [UptimeLog(segment.log_path, segment.index_path) for segment in segments]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for uptime_log in self._logs:
+            uptime_log.close()
+
+    def uptime_in_window(self, start, end):
+        """ Returns the uptime recorded in every segment between start and end. """
+        uptime = 0
+        for uptime_log in self._logs:
+            if len(uptime_log) and uptime_log.end(len(uptime_log) - 1) > start and uptime_log.start(0) < end:
+                uptime += uptime_log.uptime_in_window(start, end)
+        return uptime
+
+class UptimeSegment:
+    def __init__(self, uptime_log_directory, bucket):
+        self.bucket = bucket
+        self.log_path = os.path.join(uptime_log_directory, 'uptime-{0}.bin'.format(bucket))
+        self.index_path = os.path.join(uptime_log_directory, 'uptime-{0}.idx'.format(bucket))
+
+class _UptimeLogColumn:
+    """ Sequence of the starts or the ends of the entries of an uptime log, for use with bisect. """
+    def __init__(self, uptime_log, getter):
+        self._uptime_log = uptime_log
+        self._getter = getter
+
+    def __len__(self):
+        return len(self._uptime_log)
+
+    def __getitem__(self, index):
+        return self._getter(index)
+
+def _map_file(path, item_size):
+    """ Memory maps the complete items of a file, or returns None if there are none. """
+    try:
+        mapped_file = open(path, 'rb')
+    except (IOError, OSError):
+        # The file doesn't exist, or a compaction just deleted it.
+        return None
+    with mapped_file:
+        length = os.fstat(mapped_file.fileno()).st_size // item_size * item_size
+        # mmap can't map an empty file
+        if not length:
+            return None
+        return mmap.mmap(mapped_file.fileno(), length, access=mmap.ACCESS_READ)
+
+class Probe:
+    """ A condition that is checked in a background thread. The check only reads the result of the last completed run.
+
+    A probe that fails, raises or hasn't completed a run yet counts as down, and so does a probe that has been running
+    for longer than its timeout.
+    """
+    def __init__(self, config):
+        self.timeout = config.get('timeout', 5)
+        self.interval = config.get('interval', 15)
+        self.result = None
+        self.submitted_ts = None
+        self.running = False
+
+    def probe(self):
+        """ Returns whether the condition is up. Runs in a worker thread. """
+        raise NotImplementedError
+
+    def is_due(self, now):
+        return not self.running and (self.submitted_ts is None or now - self.submitted_ts >= self.interval)
+
+    def is_up(self, now):
+        if self.running and now - self.submitted_ts > self.timeout:
+            return False
+        return bool(self.result)
+
+class TcpProbe(Probe):
+    """ Up if a TCP connection to host:port can be opened. """
+    def __init__(self, config):
+        Probe.__init__(self, config)
+        self.address = (config['host'], int(config['port']))
+
+    def probe(self):
+        socket.create_connection(self.address, self.timeout).close()
+        return True
+
+class HttpProbe(Probe):
+    """ Up if a GET of url returns expected_status. """
+    def __init__(self, config):
+        Probe.__init__(self, config)
+        self.url = config['url']
+        self.expected_status = config.get('expected_status', 200)
+
+    def probe(self):
+        try:
+            response = urlopen(self.url, timeout=self.timeout)
+        except HTTPError as e:
+            return e.code == self.expected_status
+        try:
+            return response.getcode() == self.expected_status
+        finally:
+            response.close()
+
+class ProcessProbe(Probe):
+    """ Up if a process with the given name is running. """
+    def __init__(self, config):
+        Probe.__init__(self, config)
+        if psutil is None:
+            raise CheckException("The process probe requires psutil")
+        self.name = config['name']
+
+    def probe(self):
+        for process in psutil.process_iter():
+            try:
+                if process.name() == self.name:
+                    return True
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        return False
+
+class FileFreshnessProbe(Probe):
+    """ Up if the file at path was modified less than max_age seconds ago. """
+    def __init__(self, config):
+        Probe.__init__(self, config)
+        self.path = config['path']
+        self.max_age = config['max_age']
+
+    def probe(self):
+        return time.time() - os.path.getmtime(self.path) < self.max_age
+
+PROBE_TYPES = {
+    'tcp': TcpProbe,
+    'http': HttpProbe,
+    'process': ProcessProbe,
+    'file_freshness': FileFreshnessProbe,
+}
+
+def create_probe(config):
+    probe_class = PROBE_TYPES.get(config.get('type'))
+    if probe_class is None:
+        raise CheckException("Unknown probe type {0!r}, must be one of: {1}".format(
+            config.get('type'), ', '.join(sorted(PROBE_TYPES))))
+    try:
+        return probe_class(config)
+    except KeyError as e:
+        raise CheckException("Probe {0!r} is missing {1}".format(config, e))
+
+class ProbeRunner:
+    """ Fixed pool of daemon threads that run submitted probes. """
+    def __init__(self, workers, log):
+        self.log = log
+        self.queue = Queue()
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, probe, now):
+        probe.running = True
+        probe.submitted_ts = now
+        self.queue.put(probe)
+
+    def _work(self):
+        while True:
+            probe = self.queue.get()
+            try:
+                result = probe.probe()
+            except Exception as e:
+                self.log.debug("Probe %s failed: %s", probe.__class__.__name__, e)
+                result = False
+            probe.result = result
+            probe.running = False
+
+class GroupCommitJournal:
+    """ Durable state of every instance of the check, committed with a single write and fsync per collection cycle.
+
+    In group commit mode the uptime file of each instance isn't written on every run, and entries are appended to the
+    uptime log without an fsync. Instead the journal holds the current interval of every instance and the entries
+    appended since the last checkpoint, and is fsynced once after all instances have run. The entries are replayed
+    into the uptime log if they were lost in a crash. Every checkpoint_interval commits, the appended segments and the
+    uptime files are fsynced and the appended entries are dropped from the journal, which keeps it small.
+    """
+    def __init__(self, path, checkpoint_interval):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.commits = 0
+        self.dirty_segments = set()
+        # Instances whose appended entries have been replayed since the journal was loaded.
+        self.replayed = set()
+        self.instances = {}
+        if os.path.isfile(path):
+            with open(path) as journal_file:
+                self.instances = json.load(journal_file)
+
+    def current_interval(self, key):
+        state = self.instances.get(key)
+        return state and UptimeInterval(*state['current'])
+
+    def appended_entries(self, key):
+        state = self.instances.get(key)
+        return [UptimeInterval(*entry) for entry in state['appended']] if state else []
+
+    def record(self, key, current_interval, appended_entry=None, segment=None):
+        state = self.instances.setdefault(key, {'current': None, 'appended': []})
+        state['current'] = [current_interval.start, current_interval.end]
+        if appended_entry is not None:
+            state['appended'].append([appended_entry.start, appended_entry.end])
+            self.dirty_segments.add(segment.log_path)
+
+    def commit(self):
+        self.commits += 1
+        if self.commits % self.checkpoint_interval == 0:
+            self._checkpoint()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as tmp_journal_file:
+            json.dump(self.instances, tmp_journal_file)
+            tmp_journal_file.flush()
+            os.fsync(tmp_journal_file)
+        replace(tmp_path, self.path)
+
+    def _checkpoint(self):
+        for log_path in self.dirty_segments:
+            # A segment may have been deleted by a compaction since it was appended to.
+            if os.path.isfile(log_path):
+                # Windows can only flush files opened for writing.
+                with open(log_path, 'r+b') as segment_file:
+                    os.fsync(segment_file.fileno())
+        self.dirty_segments.clear()
+        for key, state in self.instances.items():
+            write_current_interval(UptimeInterval(*state['current']), os.path.join(key, 'uptime'))
+            state['appended'] = []
+
 class UptimeCheck(AgentCheck):
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
         self.instance_cleanup_times = {}
+        self.instance_compactions = {}
+        self.instance_probes = {}
+        init_config = init_config or {}
+        self.probe_workers = init_config.get('probe_workers', 4)
+        self.probe_runner = None
+        self.journal = None
+        if init_config.get('group_commit_journal'):
+            self.journal = GroupCommitJournal(init_config['group_commit_journal'],
+                                              init_config.get('group_commit_checkpoint_interval', 240))
+
+    def _probes_up(self, instance, now):
+        """ Submits the probes of the instance that are due, and returns whether the last result of every probe was up.
+        Never waits for a probe.
+        """
+        key = _instance_key(instance)
+        probes = self.instance_probes.get(key)
+        if probes is None:
+            probes = self.instance_probes[key] = [create_probe(config) for config in instance.get('probes', [])]
+        if probes and self.probe_runner is None:
+            self.probe_runner = ProbeRunner(self.probe_workers, self.log)
+        for probe in probes:
+            if probe.is_due(now):
+                self.probe_runner.submit(probe, now)
+        return all(probe.is_up(now) for probe in probes)
+
+    def run(self):
+        """ Runs every instance, then commits the group commit journal once for all of them. """
+        try:
+            return AgentCheck.run(self)
+        finally:
+            if self.journal is not None:
+                self.journal.commit()
 
     def check(self, instance):
         uptime_log_directory = instance['uptime_log_directory']
 
-        # Logs previous uptimes. Only updated if a downtime occurs, or if one
-        # of the past uptimes becomes older than the retention period.
-        uptime_log_path = os.path.join(uptime_log_directory, 'uptime.log')
+        # Logs previous uptimes. Only updated if a downtime occurs. Segments
+        # that only hold uptimes older than the retention period are deleted.
+        segments = list_segments(uptime_log_directory)
+        if not segments:
+            for legacy_uptime_log in ('uptime.log', 'uptime.bin'):
+                legacy_uptime_log_path = os.path.join(uptime_log_directory, legacy_uptime_log)
+                if os.path.isfile(legacy_uptime_log_path):
+                    raise CheckException(
+                        "Found an uptime log in an older format at {0}, convert it with migrate_uptime_log.py"
+                        "".format(legacy_uptime_log_path))
 
         now_ref_ts = int(time.time())
 
@@ -54,48 +429,37 @@ class UptimeCheck(AgentCheck):
         # One year in seconds: 60 * 60 * 24 * 365.25 = 31557600
         retention = instance.get('retention', 31557600)
         min_cleanup_period = instance.get('min_cleanup_period', 3600)
+        # The default segment span is 30 days: 60 * 60 * 24 * 30 = 2592000
+        segment_span = instance.get('segment_span', 2592000)
 
         last_cleanup_ts = self.instance_cleanup_times.get(_instance_key(instance))
-        if not last_cleanup_ts or last_cleanup_ts - now_ref_ts > min_cleanup_period:
-            strip_old_entries = True
+        if not last_cleanup_ts or now_ref_ts - last_cleanup_ts > min_cleanup_period:
+            self._schedule_compaction(instance, now_ref_ts - retention)
             self.instance_cleanup_times[_instance_key(instance)] = now_ref_ts
-        # no need to update if first entry is retained
-        else:
-            strip_old_entries = False
-
-        last_interval = None
-        tmp_uptime_log_path = uptime_log_path + ".tmp"
-        if os.path.isfile(uptime_log_path):
-            with open(uptime_log_path, 'r') as uptime_log_file:
-                interval = line_to_interval(uptime_log_file.readline())
-                # We will later process each line in the file, so we must seek the beginning
-                uptime_log_file.seek(0)
-                if interval:
-                    # We don't need to strip old entries if there are none.
-                    if strip_old_entries and interval.end > now_ref_ts - retention:
-                        strip_old_entries = False
-                    if strip_old_entries:
-                        with open(tmp_uptime_log_path, 'w') as tmp_uptime_log:
-                            process_uptime_log_file(uptime_log_file, metrics, tmp_uptime_log, now_ref_ts - retention)
-                            tmp_uptime_log.flush()
-                            os.fsync(tmp_uptime_log)
-                    else:
-                        process_uptime_log_file(uptime_log_file, metrics)
-            # Must wait until both files are closed
-            if strip_old_entries:
-                replace(tmp_uptime_log_path, uptime_log_path)
-            last_interval = interval
 
+        journal = self.journal
+        key = _instance_key(instance)
+        if journal is not None and key not in journal.replayed:
+            # Entries appended without an fsync may have been lost in a crash.
+            for entry in journal.appended_entries(key):
+                last_interval = read_last_interval(segments)
+                if last_interval is None or entry.end > last_interval.end:
+                    segment = add_entry_to_uptime_log(entry, segments, uptime_log_directory, segment_span, fsync=False)
+                    journal.dirty_segments.add(segment.log_path)
+                    if segment not in segments:
+                        segments.append(segment)
+            journal.replayed.add(key)
+        last_interval = read_last_interval(segments)
 
         # Tracks the current uptime. Updated each time the check is run. A
         # separate file is used to avoid copying the entire log each time the
-        # check runs.
+        # check runs. In group commit mode the journal is more recent.
         uptime_path = os.path.join(uptime_log_directory, 'uptime')
         downtime_threshold = instance['downtime_threshold']
-        prev_interval = read_uptime_interval(uptime_path)
+        prev_interval = journal and journal.current_interval(key) or read_uptime_interval(uptime_path)
+        up = is_up() and self._probes_up(instance, now_ref_ts)
         current_interval = get_current_interval(now_ref_ts, prev_interval,
-                                                downtime_threshold)
-        update_metrics_with_interval(metrics, current_interval)
+                                                downtime_threshold, up)
 
         # The following conditions must be met for us to add an interval to
         # the uptime log:
@@ -109,31 +473,123 @@ class UptimeCheck(AgentCheck):
         # before writing the current interval, we may find ourselves trying to
         # add an entry to the uptime log that already exists the next time the
         # check runs. Entries in the uptime log should be unique, so we must
-        # check that the entry hasn't already been added. We check the second
-        # entry to guard against a partial write, which would corrupt the log
-        # file (which could be fixed with manual intervention), but would not cause
-        # any uptime date to be lost.
+        # check that the entry hasn't already been added. A partially written
+        # entry is ignored when reading the log and overwritten by the next
+        # entry, so it can't corrupt the log.
         if (prev_interval and current_interval.start != prev_interval.start and
                 prev_interval.start != prev_interval.end and
                 (last_interval is None or
                     last_interval.end != prev_interval.end)):
-            # add_entry_to_uptime_log(prev_interval, uptime_log_path)
-            # The uptime log will be updated relatively infrequently, so it doesn't
-            # make sense to add extra code to append entries when adding an interval.
-            update_metrics_with_interval(metrics, prev_interval)
-            add_entry_to_uptime_log(prev_interval, uptime_log_path)
+            segment = add_entry_to_uptime_log(prev_interval, segments, uptime_log_directory, segment_span,
+                                              fsync=journal is None)
+            if segment not in segments:
+                segments.append(segment)
+            appended_entry = prev_interval
+        else:
+            segment = appended_entry = None
 
-        write_current_interval(current_interval, uptime_path)
+        # Down with no previous interval, e.g. on the first run of an instance whose probes don't answer yet: there is
+        # no current interval until the host is first seen up.
+        if current_interval is not None:
+            if journal is not None:
+                journal.record(key, current_interval, appended_entry, segment)
+            else:
+                write_current_interval(current_interval, uptime_path)
 
+        # Each segment's index holds the prefix sums of its entries, so the
+        # uptime of any timespan is answered with two binary searches and a
+        # subtraction per segment, however many entries or metrics there are.
+        for segment in segments:
+            sync_uptime_index(segment.log_path, segment.index_path)
+        with SegmentedUptimeLog(segments) as uptime_log:
+            for metric in metrics:
+                metric.value = uptime_log.uptime_in_window(metric.start, metric.end)
+        if current_interval is not None:
+            update_metrics_with_interval(metrics, current_interval)
         for metric in metrics:
             self.gauge(metric.name, float(metric.value) / (metric.end - metric.start))
 
-def process_uptime_log_file(uptime_log_file, metrics, new_uptime_log_file=None, retention_min_ts=None):
-    for line in uptime_log_file:
-        interval = line_to_interval(line)
-        update_metrics_with_interval(metrics, interval)
-        if new_uptime_log_file and interval.end > retention_min_ts:
-            new_uptime_log_file.write(line)
+    def _schedule_compaction(self, instance, retention_min_ts):
+        """ Deletes the expired segments of the instance in a background thread, so that the collector never waits on
+        it. Nothing is scheduled while the previous compaction of the instance is still running.
+        """
+        compaction = self.instance_compactions.get(_instance_key(instance))
+        if compaction is not None and compaction.is_alive():
+            return
+        compaction = threading.Thread(target=self._compact_uptime_log,
+                                      args=(instance['uptime_log_directory'], retention_min_ts))
+        compaction.daemon = True
+        self.instance_compactions[_instance_key(instance)] = compaction
+        compaction.start()
+
+    def _compact_uptime_log(self, uptime_log_directory, retention_min_ts):
+        try:
+            compact_uptime_log(uptime_log_directory, retention_min_ts)
+        except Exception:
+            self.log.exception("Failed to compact the uptime log in %s", uptime_log_directory)
+
+def list_segments(uptime_log_directory):
+    """ Returns the segments of the uptime log, oldest first. """
+    if not os.path.isdir(uptime_log_directory):
+        return []
+    buckets = []
+    for filename in os.listdir(uptime_log_directory):
+        match = SEGMENT_RE.match(filename)
+        if match:
+            buckets.append(int(match.group(1)))
+    return [UptimeSegment(uptime_log_directory, bucket) for bucket in sorted(buckets)]
+
+def compact_uptime_log(uptime_log_directory, retention_min_ts):
+    """ Deletes the segments whose entries all ended before retention_min_ts.
+
+    The newest segment is always kept since entries are appended to it. A segment that can't be deleted right now (for
+    example because it is mapped on Windows) is deleted by a later compaction.
+    """
+    for segment in list_segments(uptime_log_directory)[:-1]:
+        last_interval = read_last_interval([segment])
+        if last_interval is not None and last_interval.end > retention_min_ts:
+            # Segments are in order, so every later segment is retained as well.
+            break
+        try:
+            # The index is deleted first, since a log without an index is repaired but an index without a log isn't.
+            if os.path.exists(segment.index_path):
+                os.remove(segment.index_path)
+            os.remove(segment.log_path)
+        except OSError:
+            break
+
+def sync_uptime_index(uptime_log_path, uptime_index_path):
+    """ Brings the index up to date with the uptime log.
+
+    The index is only appended to after an entry has been fsynced to the log, so at worst it is missing the prefix sums
+    of the last entries, or ends with a partially written one. Those are recomputed here. The index can always be
+    rebuilt from the log, so it doesn't need to be fsynced.
+    """
+    if not os.path.isfile(uptime_log_path):
+        return
+    log_count = os.path.getsize(uptime_log_path) // RECORD.size
+    index_size = os.path.getsize(uptime_index_path) if os.path.isfile(uptime_index_path) else None
+    if index_size == log_count * PREFIX_SUM.size:
+        return
+
+    index_count = min((index_size or 0) // PREFIX_SUM.size, log_count)
+    with open(uptime_log_path, 'rb') as uptime_log, \
+            open(uptime_index_path, 'wb' if index_size is None else 'r+b') as uptime_index:
+        prefix_sum = 0
+        if index_count:
+            uptime_index.seek((index_count - 1) * PREFIX_SUM.size)
+            uptime_log.seek((index_count - 1) * RECORD.size)
+            start, end = RECORD.unpack(uptime_log.read(RECORD.size))
+            prefix_sum = PREFIX_SUM.unpack(uptime_index.read(PREFIX_SUM.size))[0] + end - start
+        records = uptime_log.read((log_count - index_count) * RECORD.size)
+        prefix_sums = []
+        for offset in range(0, len(records), RECORD.size):
+            start, end = RECORD.unpack_from(records, offset)
+            prefix_sums.append(PREFIX_SUM.pack(prefix_sum))
+            prefix_sum += end - start
+        uptime_index.seek(index_count * PREFIX_SUM.size)
+        uptime_index.write(b''.join(prefix_sums))
+        uptime_index.truncate()
 
 def update_metrics_with_interval(metrics, interval):
     for metric in metrics:
@@ -151,11 +607,11 @@ def _instance_key(instance):
     return instance['uptime_log_directory']
 
 # Generate the current uptime interval. The current interval depends
-# the previous interval (whether it's None, how long ago it ended) and
-# the downtime_threshold (did the previous interval end longer than
-# downtime_threshold seconds ago).
-def get_current_interval(current_time, prev_interval, downtime_threshold):
-    if not is_up():
+# the previous interval (whether it's None, how long ago it ended), whether
+# is_up and the probes report that we're up, and the downtime_threshold (did
+# the previous interval end longer than downtime_threshold seconds ago).
+def get_current_interval(current_time, prev_interval, downtime_threshold, up=True):
+    if not up:
         return prev_interval
     if (not prev_interval or
             current_time - prev_interval.end > downtime_threshold):
@@ -174,11 +630,41 @@ def write_current_interval(current_interval, uptime_path):
         os.fsync(tmp_uptime_file)
     replace(tmp_uptime_path, uptime_path)
 
-def add_entry_to_uptime_log(prev_interval, uptime_log_path):
-    with open(uptime_log_path, 'a') as uptime_log:
-        uptime_log.write(interval_to_line(prev_interval))
+def add_entry_to_uptime_log(prev_interval, segments, uptime_log_directory, segment_span, fsync=True):
+    """ Appends the entry to the segment of its time bucket and returns that segment.
+
+    Entries are never added to a segment older than the newest one, which keeps the segments in order even if
+    segment_span was changed. In group commit mode the entry is made durable by the journal instead of an fsync.
+    """
+    bucket = prev_interval.start - prev_interval.start % segment_span
+    if segments and segments[-1].bucket >= bucket:
+        segment = segments[-1]
+    else:
+        segment = UptimeSegment(uptime_log_directory, bucket)
+    mode = 'r+b' if os.path.isfile(segment.log_path) else 'wb'
+    with open(segment.log_path, mode) as uptime_log:
+        # Append after the last complete record, overwriting any partially written one.
+        uptime_log.seek(0, os.SEEK_END)
+        uptime_log.seek(uptime_log.tell() // RECORD.size * RECORD.size)
+        uptime_log.write(RECORD.pack(prev_interval.start, prev_interval.end))
+        uptime_log.truncate()
         uptime_log.flush()
-        os.fsync(uptime_log)
+        if fsync:
+            os.fsync(uptime_log)
+    return segment
+
+def read_last_interval(segments):
+    """ Returns the last complete entry of the newest non-empty segment. """
+    for segment in reversed(segments):
+        try:
+            with open(segment.log_path, 'rb') as uptime_log:
+                count = os.fstat(uptime_log.fileno()).st_size // RECORD.size
+                if count:
+                    uptime_log.seek((count - 1) * RECORD.size)
+                    return UptimeInterval(*RECORD.unpack(uptime_log.read(RECORD.size)))
+        except (IOError, OSError):
+            pass
+    return None
 
 def interval_to_line(interval):
     return "{0} {1}\n".format(interval.start, interval.end)